@@ -1,7 +1,10 @@
-from collections import defaultdict
+import os
+import tempfile
+import threading
 
 import numpy as np
 import torch
+import torch.distributed as dist
 from torch.distributions.multivariate_normal import MultivariateNormal
 import torch.nn as nn
 import torch.nn.functional as F
@@ -12,28 +15,33 @@ from . import utilities
 ### Utility classes
 class AdvancedMemoryBuffer:
     "Memory-efficient implementation of memory"
-    def __init__(self, suffix_len, rs_nset=1e5, split_args={}):
+    def __init__(self, suffix_len, rs_nset=1e5, split_args={}, state_compression=None):
         # User parameters
         self.suffix_len = suffix_len
         self.split_args = split_args
+        self.state_compression = state_compression  # None, `float16`, `bfloat16`, or `int8`
+        if state_compression not in (None, 'float16', 'bfloat16', 'int8'):
+            raise ValueError(f'State compression \'{state_compression}\' not found.')
+        self.rng = None  # Generator seeding unreproducible `split_state` sampling, global random state if `None`
 
         # Storage variables
         self.storage = {
-            'keys': [],             # Lists containing keys in the first dim of states
-            'states': [],           # State tensors of dim `keys x non-suffix features`
+            'keys': [],             # Integer key ids for the first dim of states
+            'states': [],           # State tensors of dim `keys x non-suffix features`, compressed
             'actions': [],          # Actions
             'action_logs': [],      # Action probabilities
             'state_vals': [],       # Critic evaluation of state
-            'rewards': [],          # Rewards, list of lists
+            'rewards': [],          # Reward tensors, kept on their recorded device
             'is_terminals': [],     # Booleans indicating if the terminal state has been reached
         }
         self.persistent_storage = {
-            'suffixes': {},         # Suffixes corresponding to keys
-            'suffix_matrices': {},  # Orderings of suffixes
+            'key_ids': {},          # Integer id for each key
+            'suffixes': None,       # Suffix table of dim `key ids x suffix features`
         }
 
         # Maintenance variables
         self.recorded = {k: False for k in self.storage}
+        self.flat_cache = {}  # Flattened views of storage, invalidated on change
 
         # Moving statistics
         self.running_statistics = utilities.RunningStatistics(n_set=rs_nset)
@@ -42,93 +50,109 @@ class AdvancedMemoryBuffer:
         # Parameters
         if not utilities.is_list_like(idx): idx = [idx]
         idx = np.array(idx)
+        offsets = self._get_offsets()
+        out_of_range = (idx < 0) + (idx >= offsets[-1])
+        if out_of_range.any(): raise IndexError(f'Index {idx[out_of_range][0]} out of range')
+
+        # Gather memories
+        ret = {k: self._gather(k, idx) for k in ('actions', 'action_logs', 'state_vals')}
+
+        # Group indices by timestep
+        timesteps = np.searchsorted(offsets, idx, side='right') - 1
+        order = np.argsort(timesteps, kind='stable')
+        unique_timesteps, group_starts = np.unique(timesteps[order], return_index=True)
+
+        # Reconstruct states once per timestep
+        # NOTE: `_get_timestep_state` takes most time without caching, then `split_state`
+        states = []
+        for t, group in zip(unique_timesteps, np.split(order, group_starts[1:])):
+            split_args = self.split_args
+            if self.rng is not None and split_args.get('reproducible_strategy') is None:
+                split_args = {**split_args, 'reproducible_strategy': int(self.rng.integers(2**62))}
+            states.append(utilities.split_state(
+                self._get_timestep_state(t),
+                idx=(idx[group] - offsets[t]).tolist(),
+                **split_args,
+            ))
+
+        # Return to indexing order
+        inverse_order = np.argsort(order)
+        ret['states'] = [torch.concat([s[i] for s in states], dim=0)[inverse_order] for i in range(2)]
 
-        # Initialization
-        ret = defaultdict(lambda: [])
-
-        # Sort idx
-        sort_idx = np.argsort(idx)
-        sort_inverse_idx = np.argsort(sort_idx)
-
-        # Search for index
-        current_index = 0
-        running_index = 0
-        sorted_idx = idx[sort_idx]
-        for list_num in range(len(self.storage['keys'])):
-            list_len = len(self.storage['keys'][list_num])
-            while current_index < len(idx) and running_index + list_len > sorted_idx[current_index]:
-                # Useful shortcuts
-                local_idx = sorted_idx[current_index] - running_index
-
-                # Get values
-                for k in self.storage:
-                    # Skip certain keys
-                    if k in ['keys', 'rewards', 'is_terminals']: continue
-
-                    # Special cases
-                    if k == 'states':
-                        # `_append_suffix` takes most time without caching, then `split_state`
-                        val = utilities.split_state(  # TIME BOTTLENECK
-                            self._append_suffix(self.storage[k][list_num], keys=self.storage['keys'][list_num]),  # TIME BOTTLENECK
-                            idx=local_idx,
-                            **self.split_args,
-                        )
-
-                    # Main case
-                    else:
-                        val = self.storage[k][list_num][local_idx]
-
-                    # Record
-                    ret[k].append(val)
-
-                # Iterate
-                current_index += 1
-
-            # Iterate list start
-            running_index += list_len
-
-            # Break if idx retrieved
-            if current_index >= len(idx): break
-
-        # Catch if not all found
-        if current_index < len(idx): raise IndexError(f'Index {sorted_idx[current_index]} out of range')
-
-        # Sort to indexing order and stack
-        for k in ret:
-            # Sort
-            ret[k] = [ret[k][i] for i in sort_inverse_idx]
-
-            # Stack
-            if k == 'states':
-                ret[k] = [torch.concat([s[i] for s in ret[k]], dim=0) for i in range(2)]
-            else:
-                ret[k] = torch.stack(ret[k], dim=0)
-
-        return dict(ret)
+        return ret
 
     def __len__(self):
         return sum(len(keys) for keys in self.storage['keys'])
 
-    def _append_suffix(self, state, *, keys, cache=True):
-        "Append suffixes to state vector with optional cache for common key layouts"
-        # Read from cache
-        # NOTE: Strings from numpy arrays are slower as keys
-        if cache and keys in self.persistent_storage['suffix_matrices']:
-            suffix_matrix = self.persistent_storage['suffix_matrices'][keys]
-
-        else:
-            # Aggregate suffixes
-            suffix_matrix = None
-            for k in keys:
-                val = self.persistent_storage['suffixes'][k].unsqueeze(0)
-                if suffix_matrix is None: suffix_matrix = val
-                else: suffix_matrix = torch.concat((suffix_matrix, val), dim=0)
-
-            # Add to cache
-            if cache: self.persistent_storage['suffix_matrices'][keys] = suffix_matrix
-
-        # Append to state
-        return torch.concat((state, suffix_matrix), dim=1)
+    def _get_offsets(self):
+        "Get the first flat index of each timestep, followed by the total length"
+        if 'offsets' not in self.flat_cache:
+            self.flat_cache['offsets'] = np.concatenate(([0], np.cumsum([len(keys) for keys in self.storage['keys']], dtype=np.int64)))
+        return self.flat_cache['offsets']
+
+    def _get_column(self, k):
+        "Get variable `k` for all memories as a single tensor"
+        if k not in self.flat_cache: self.flat_cache[k] = torch.concat(self.storage[k], dim=0)
+        return self.flat_cache[k]
+
+    def _gather(self, k, idx):
+        "Get variable `k` at flat indices `idx`"
+        return self._get_column(k)[idx]
+
+    def _get_timestep_state(self, t):
+        "Reconstruct the full state of timestep `t`"
+        states = self.storage['states'][t]
+        states = self._decompress_states(*states) if isinstance(states, tuple) else self._decompress_states(states)
+        return self._append_suffix(states, key_ids=self.storage['keys'][t])
+
+    def _compress_states(self, states):
+        "Compress non-suffix states for storage, returning quantization parameters if needed"
+        if self.state_compression is None: return states, None
+        if self.state_compression in ('float16', 'bfloat16'): return states.to(getattr(torch, self.state_compression)), None
+
+        # Per-feature affine int8 quantization over the timestep
+        low, high = states.min(dim=0).values, states.max(dim=0).values
+        scale = (high - low).clamp(min=1e-12) / 255
+        return torch.round((states - low) / scale - 128).to(torch.int8), torch.stack((low, scale))
+
+    def _decompress_states(self, states, params=None):
+        "Decompress stored non-suffix states"
+        if params is not None: return (states.float() + 128) * params[1] + params[0]
+        return states.float()
+
+    def _append_suffix(self, state, *, key_ids):
+        "Append suffixes to state vector from the suffix table"
+        return torch.concat((state, self.persistent_storage['suffixes'].index_select(0, key_ids)), dim=1)
+
+    def _get_key_ids(self, keys, states):
+        "Get integer ids for `keys`, adding suffixes from `states` to the table for unseen keys"
+        # Assign ids
+        # NOTE: Tensor elements hash by identity, so are converted first
+        if isinstance(keys, torch.Tensor): keys = keys.tolist()
+        key_ids = self.persistent_storage['key_ids']
+        ids, new_rows = [], []
+        for j, k in enumerate(keys):
+            if k not in key_ids:
+                key_ids[k] = len(key_ids)
+                new_rows.append(j)
+            ids.append(key_ids[k])
+        ids = torch.tensor(ids, dtype=torch.long)
+
+        # Add suffixes, doubling the table as needed
+        if len(new_rows) > 0:
+            table = self.persistent_storage['suffixes']
+            if table is None or table.shape[0] < len(key_ids):
+                new_table = torch.empty((max(len(key_ids), 2 * table.shape[0] if table is not None else 0), self.suffix_len), dtype=states.dtype)
+                if table is not None: new_table[:table.shape[0]] = table
+                self.persistent_storage['suffixes'] = table = new_table
+            table[ids[new_rows]] = states[new_rows, -self.suffix_len:].detach().cpu()
+
+        return ids
+
+    def _reset_persistent_storage(self):
+        "Forget all keys and suffixes"
+        self.persistent_storage['key_ids'] = {}
+        self.persistent_storage['suffixes'] = None
 
     def _flat_index_to_index(self, idx):
         "Convert int index to grouped format that can be used on keys, state, etc."
@@ -136,14 +160,10 @@ class AdvancedMemoryBuffer:
         assert not utilities.is_list_like(idx) and idx >= 0, 'Index must be a positive integer'
 
         # Search for index
-        running_index = 0
-        for list_num in range(len(self.keys)):
-            list_len = len(self.keys[list_num])
-            if running_index + list_len > idx:
-                return (list_num, idx - running_index)
-
-        # Throw error if not found
-        raise IndexError('Index out of range')
+        offsets = self._get_offsets()
+        if idx >= offsets[-1]: raise IndexError('Index out of range')
+        list_num = np.searchsorted(offsets, idx, side='right') - 1
+        return (list_num, idx - offsets[list_num])
 
     def record(self, **kwargs):
         "Record passed variables"
@@ -151,67 +171,326 @@ class AdvancedMemoryBuffer:
         for k in kwargs:
             assert k in self.storage, f'`{k}` not found in memory object'
             assert not self.recorded[k], f'`{k}` has already been recorded for this record'
+        self.flat_cache.clear()
 
         # Store new variables
         for k, v in kwargs.items():
-            # Special cases
-            # NOTE: For some god-forsaken reason, traeating this as an np array or non-sequential list brings unimaginable problems (2x backwards time)
-            if k == 'keys': v = tuple(v)
-
-            # Record
+            if k == 'rewards': v = torch.as_tensor(v, dtype=torch.float32)
             self.storage[k].append(v)
             self.recorded[k] = True
 
         # Reset if all variables have been recorded
         if np.array([v for _, v in self.recorded.items()]).all():
-            # Gleam suffixes
-            for j, k in enumerate(self.storage['keys'][-1]):
-                if k not in self.persistent_storage['suffixes']:
-                    self.persistent_storage['suffixes'][k] = self.storage['states'][-1][j][-self.suffix_len:].clone().cpu()
+            # Gleam suffixes and convert keys to ids
+            self.storage['keys'][-1] = self._get_key_ids(self.storage['keys'][-1], self.storage['states'][-1])
 
-            # Cut suffixes
+            # Cut suffixes and compress
             # Note: MUST BE CLONED otherwise stores whole unsliced tensor
-            self.storage['states'][-1] = self.storage['states'][-1][..., :-self.suffix_len].clone().cpu()
+            states, params = self._compress_states(self.storage['states'][-1][..., :-self.suffix_len].clone().cpu())
+            self.storage['states'][-1] = states if params is None else (states, params)
 
             # Set all variables as unrecorded
             for k in self.recorded: self.recorded[k] = False
 
+    def _get_reward_columns(self):
+        "Get integer key ids and rewards for all memories, and terminal flags for each timestep"
+        return (
+            self._get_column('keys').numpy(),
+            self._get_column('rewards').double().cpu().numpy(),
+            np.array(self.storage['is_terminals'], dtype=bool),
+        )
+
+    def mean_reward(self):
+        "Mean of all recorded rewards"
+        return self._get_column('rewards').mean().item()
+
+    def _scan_returns(self, gamma, gae_lambda=None):
+        "Reverse scan over timesteps for discounted returns, memories since terminal, and optional GAE terms"
+        # Get flattened memories
+        offsets = self._get_offsets()
+        key_ids, rewards, is_terminals = self._get_reward_columns()
+        num_keys = key_ids.max() + 1
+
+        # Initialize
+        returns, counts = np.empty(len(rewards)), np.empty(len(rewards), dtype=np.int64)
+        running_returns, running_counts = np.zeros(num_keys), np.zeros(num_keys, dtype=np.int64)
+        if gae_lambda is not None:
+            # Advantages are linear in the reward statistics, A = P + std * Q + mean * S,
+            # so terms are scanned separately and combined once statistics are updated
+            values = self._get_column('state_vals').reshape(-1).double().numpy()
+            terms, running_terms = np.empty((3, len(rewards))), np.zeros((3, num_keys))
+            next_values, has_next = np.zeros(num_keys), np.zeros(num_keys)
+
+        # Scan, resetting keys present at terminal states
+        # NOTE: Keys absent from a timestep carry their running values without decay
+        for t in reversed(range(len(offsets) - 1)):
+            start, end = offsets[t], offsets[t+1]
+            ids = key_ids[start:end]
+            if is_terminals[t]:
+                running_returns[ids], running_counts[ids] = 0, 0
+                if gae_lambda is not None: running_terms[:, ids], has_next[ids] = 0, 0
+            running_returns[ids] = rewards[start:end] + gamma * running_returns[ids]
+            running_counts[ids] += 1
+            returns[start:end], counts[start:end] = running_returns[ids], running_counts[ids]
+            if gae_lambda is not None:
+                # TD residuals of unnormalized values, split by coefficient
+                deltas = np.stack((
+                    rewards[start:end],
+                    gamma * has_next[ids] * next_values[ids] - values[start:end],
+                    gamma * has_next[ids] - 1,
+                ))
+                running_terms[:, ids] = deltas + gamma * gae_lambda * running_terms[:, ids]
+                terms[:, start:end] = running_terms[:, ids]
+                next_values[ids], has_next[ids] = values[start:end], 1
+
+        return returns, counts, (terms if gae_lambda is not None else None)
+
     def propagate_rewards(self, gamma=.95, prune=0):
         "Propagate rewards with decay"
-        ret, ret_prune = [], []
-        running_rewards = {k: 0 for k in np.unique(sum(self.storage['keys'], ()))}
-        running_prune = {k: 0 for k in np.unique(sum(self.storage['keys'], ()))}
-        for keys, rewards, is_terminal in zip(self.storage['keys'][::-1], self.storage['rewards'][::-1], self.storage['is_terminals'][::-1]):
-            for key, reward in zip(keys[::-1], rewards[::-1]):
-                if is_terminal:
-                    running_rewards[key] = 0  # Reset at terminal state
-                    if prune is not None: running_prune[key] = 0
-                running_rewards[key] = reward + gamma * running_rewards[key]
-                ret.append(running_rewards[key])
-                if prune is not None:
-                    running_prune[key] += 1
-                    ret_prune.append(running_prune[key] > prune)
-        ret = ret[::-1]
-        ret = torch.tensor(ret, dtype=torch.float32)
-        if prune is not None:
-            ret_prune = ret_prune[::-1]
-            ret_prune = torch.tensor(ret_prune, dtype=torch.bool)
+        returns, counts, _ = self._scan_returns(gamma)
+        ret = torch.tensor(returns, dtype=torch.float32)
+        if prune is not None: ret_prune = torch.tensor(counts > prune)
 
         # Need to normalize AFTER propagation
-        for r, p in zip(ret, ret_prune):
-            # Don't include pruned rewards in update
-            if p: self.running_statistics.update(r)
+        # Don't include pruned rewards in update
+        if prune is not None: self.running_statistics.update_batch(ret[ret_prune])
         ret = (ret - self.running_statistics.mean()) / (torch.sqrt(self.running_statistics.variance() + 1e-8))
 
         if prune is not None:
             return ret, ret_prune
         return ret
 
+    def estimate_advantages(self, gamma=.95, gae_lambda=None, prune=0):
+        "Get normalized value targets, advantages, and unpruned mask, using GAE if `gae_lambda` is provided"
+        # Monte-Carlo
+        if gae_lambda is None:
+            returns = self.propagate_rewards(gamma=gamma, prune=prune)
+            if prune is not None: returns, mask = returns
+            else: mask = torch.ones(len(returns), dtype=bool)
+            advantages = returns - self._get_column('state_vals').reshape(-1)
+            return returns, advantages, mask
+
+        # Generalized advantage estimation
+        returns, counts, terms = self._scan_returns(gamma, gae_lambda=gae_lambda)
+        mask = torch.tensor(counts > prune) if prune is not None else torch.ones(len(returns), dtype=bool)
+        if prune is not None: self.running_statistics.update_batch(torch.tensor(returns)[mask])
+        mean = torch.as_tensor(self.running_statistics.mean(), dtype=torch.float64)
+        std = torch.sqrt(torch.as_tensor(self.running_statistics.variance(), dtype=torch.float64) + 1e-8)
+        terms = torch.tensor(terms)
+        advantages = ((terms[0] + std * terms[1] + mean * terms[2]) / std).float()
+        returns = advantages + self._get_column('state_vals').reshape(-1).float()
+        return returns, advantages, mask
+
     def clear(self, clear_persistent=False):
         "Clear memory"
         for k in self.storage: self.storage[k].clear()
-        if clear_persistent:
-            for k in self.persistent_storage: self.persistent_storage[k].clear()
+        self.flat_cache.clear()
+        if clear_persistent: self._reset_persistent_storage()
+
+    def state_dict(self):
+        "Get recorded memories and reward statistics"
+        # NOTE: Lists are copied, recorded tensors are never modified in place
+        return {
+            'storage': {k: list(v) for k, v in self.storage.items()},
+            **self._persistent_state_dict(),
+            'running_statistics': self.running_statistics.state_dict(),
+        }
+
+    def _persistent_state_dict(self):
+        "Get keys and used rows of the suffix table"
+        table, key_ids = self.persistent_storage['suffixes'], self.persistent_storage['key_ids']
+        return {'key_ids': dict(key_ids), 'suffixes': table[:len(key_ids)].clone() if table is not None else None}
+
+    def load_state_dict(self, state_dict):
+        "Load recorded memories and reward statistics"
+        self.storage = state_dict['storage']
+        self.flat_cache.clear()
+        self.persistent_storage['key_ids'] = dict(state_dict['key_ids'])
+        self.persistent_storage['suffixes'] = state_dict['suffixes']
+        self.running_statistics.load_state_dict(state_dict['running_statistics'])
+        for k in self.recorded: self.recorded[k] = False
+
+
+class ColumnarMemoryBuffer(AdvancedMemoryBuffer):
+    "Memory stored in contiguous preallocated columns with a timestep offset index"
+    def __init__(self, suffix_len, capacity=None, **kwargs):
+        super().__init__(suffix_len, **kwargs)
+
+        # User parameters
+        self.capacity = capacity  # Timesteps to preallocate for, grown if exceeded
+
+        # Storage variables
+        # NOTE: Timestep columns have one row per timestep, all others have one row per memory
+        self.storage = {k: None for k in self.storage}  # Columns, allocated on first record
+        self.storage['state_params'] = None  # Quantization parameters, only used for `int8` compression
+        self.timestep_columns = ('is_terminals', 'state_params')
+        self.offsets = np.zeros((capacity if capacity is not None else 1) + 1, dtype=np.int64)  # Start row of each timestep
+        self.num_timesteps = 0
+        self.num_rows = 0
+        self.pending_rows = None  # Rows in the timestep being recorded
+
+    def __len__(self):
+        return self.num_rows
+
+    def _get_offsets(self):
+        "Get the first flat index of each timestep, followed by the total length"
+        return self.offsets[:self.num_timesteps+1]
+
+    def _get_column(self, k):
+        "Get variable `k` for all memories as a single tensor"
+        return self.storage[k][:self.num_rows]
+
+    def _write(self, k, v, start):
+        "Write `v` to column `k` at row `start`, allocating or growing the column as needed"
+        end = start + v.shape[0]
+        column = self.storage[k]
+        if column is None or column.shape[0] < end:
+            # Preallocate `capacity` timesteps initially, then double
+            if column is None: rows = max(end, v.shape[0] * (self.capacity if self.capacity is not None else 1))
+            else: rows = max(end, 2 * column.shape[0])
+            new_column = self._allocate((rows, *v.shape[1:]), v.dtype, device=v.device)
+            if column is not None:
+                new_column[:start] = column[:start]
+                self._release(column)
+            self.storage[k] = column = new_column
+        column[start:end] = v
+
+    def _allocate(self, shape, dtype, device='cpu'):
+        "Allocate an uninitialized column"
+        return torch.empty(shape, dtype=dtype, device=device)
+
+    def _release(self, column):
+        "Release resources of a replaced column"
+        pass
+
+    def _get_timestep_state(self, t):
+        "Reconstruct the full state of timestep `t`"
+        start, end = self.offsets[t], self.offsets[t+1]
+        params = self.storage['state_params'][t] if self.state_compression == 'int8' else None
+        states = self._decompress_states(self.storage['states'][start:end], params)
+        return self._append_suffix(states, key_ids=self.storage['keys'][start:end])
+
+    def record(self, **kwargs):
+        "Record passed variables"
+        # Check that passed variables haven't been stored yet for this record
+        for k in kwargs:
+            assert k in self.storage, f'`{k}` not found in memory object'
+            assert not self.recorded[k], f'`{k}` has already been recorded for this record'
+        assert ('keys' in kwargs) == ('states' in kwargs), '`keys` and `states` must be recorded together'
+
+        # Gleam suffixes and convert keys to ids
+        if 'keys' in kwargs:
+            key_ids = self._get_key_ids(kwargs['keys'], kwargs['states'])
+            self.pending_rows = len(key_ids)
+
+        # Store new variables
+        for k, v in kwargs.items():
+            # Format
+            if k == 'keys': v = key_ids
+            elif k == 'states':
+                # Cut suffixes and compress
+                v, params = self._compress_states(v[..., :-self.suffix_len].detach().cpu())
+                if params is not None: self._write('state_params', params.unsqueeze(0), self.num_timesteps)
+            elif k == 'rewards': v = torch.as_tensor(v, dtype=torch.float32)  # Kept on device
+            elif k == 'is_terminals': v = torch.tensor([v], dtype=torch.bool)
+            else: v = v.detach().cpu()
+
+            # Record
+            self._write(k, v, self.num_timesteps if k in self.timestep_columns else self.num_rows)
+            self.recorded[k] = True
+
+        # Index timestep if all variables have been recorded
+        if np.array([v for _, v in self.recorded.items()]).all():
+            if self.num_timesteps + 2 > self.offsets.shape[0]:
+                self.offsets = np.concatenate((self.offsets, np.zeros_like(self.offsets)))
+            self.num_rows += self.pending_rows
+            self.num_timesteps += 1
+            self.offsets[self.num_timesteps] = self.num_rows
+
+            # Set all variables as unrecorded
+            for k in self.recorded: self.recorded[k] = False
+
+    def _get_reward_columns(self):
+        "Get integer key ids and rewards for all memories, and terminal flags for each timestep"
+        return (
+            self.storage['keys'][:self.num_rows].numpy(),
+            self.storage['rewards'][:self.num_rows].double().cpu().numpy(),
+            self.storage['is_terminals'][:self.num_timesteps].numpy(),
+        )
+
+    def mean_reward(self):
+        "Mean of all recorded rewards"
+        return self.storage['rewards'][:self.num_rows].mean().item()
+
+    def clear(self, clear_persistent=False):
+        "Clear memory, keeping allocated columns"
+        self.num_timesteps = 0
+        self.num_rows = 0
+        for k in self.recorded: self.recorded[k] = False
+        if clear_persistent: self._reset_persistent_storage()
+
+    def state_dict(self):
+        "Get recorded memories and reward statistics"
+        # NOTE: Columns are views, valid until `clear` as recorded rows are never overwritten before then
+        return {
+            'storage': {
+                k: v[:self.num_timesteps if k in self.timestep_columns else self.num_rows] if v is not None else None
+                for k, v in self.storage.items()},
+            'offsets': self.offsets[:self.num_timesteps+1].copy(),
+            **self._persistent_state_dict(),
+            'running_statistics': self.running_statistics.state_dict(),
+        }
+
+    def load_state_dict(self, state_dict):
+        "Load recorded memories and reward statistics"
+        for k, v in state_dict['storage'].items():
+            if self.storage[k] is not None: self._release(self.storage[k])
+            self.storage[k] = None
+            if v is not None and v.shape[0] > 0:
+                self.storage[k] = self._allocate(v.shape, v.dtype, device=v.device)
+                self.storage[k][:] = v
+        self.offsets = state_dict['offsets'].copy()
+        self.num_timesteps = self.offsets.shape[0] - 1
+        self.num_rows = int(self.offsets[-1])
+        self.persistent_storage['key_ids'] = dict(state_dict['key_ids'])
+        self.persistent_storage['suffixes'] = state_dict['suffixes']
+        self.running_statistics.load_state_dict(state_dict['running_statistics'])
+        for k in self.recorded: self.recorded[k] = False
+
+
+class MemmapMemoryBuffer(ColumnarMemoryBuffer):
+    "Columnar memory spilled to `numpy.memmap` files on disk, gathered in file order"
+    def __init__(self, suffix_len, directory=None, **kwargs):
+        # Storage files, removed along with the buffer
+        self.directory = tempfile.TemporaryDirectory(prefix='celltrip-memory-', dir=directory)
+        self.num_files = 0
+        self.files = {}  # Data pointer of each column to its file
+
+        super().__init__(suffix_len, **kwargs)
+
+    def _allocate(self, shape, dtype, device='cpu'):
+        "Allocate an uninitialized column backed by a new file"
+        # Device columns, i.e. rewards, aren't spilled
+        if torch.device(device).type != 'cpu': return super()._allocate(shape, dtype, device=device)
+
+        fname = os.path.join(self.directory.name, f'{self.num_files}.dat')
+        self.num_files += 1
+        # NOTE: Numpy has no bfloat16, so its bits are stored as int16
+        np_dtype = torch.empty(0, dtype=dtype if dtype != torch.bfloat16 else torch.int16).numpy().dtype
+        column = torch.from_numpy(np.memmap(fname, dtype=np_dtype, mode='w+', shape=shape)).view(dtype)
+        self.files[column.data_ptr()] = fname
+        return column
+
+    def _release(self, column):
+        "Remove the file of a replaced column"
+        # NOTE: Existing views stay readable, the mapping outlives the directory entry
+        fname = self.files.pop(column.data_ptr(), None)
+        if fname is not None: os.remove(fname)
+
+    def _gather(self, k, idx):
+        "Get variable `k` at flat indices `idx`, reading rows in ascending order"
+        order = np.argsort(idx, kind='stable')
+        return self._get_column(k)[idx[order]][np.argsort(order)]
 
 
 class ResidualSA(nn.Module):
@@ -422,9 +701,11 @@ class PPO(nn.Module):
             action_std_decay=.05,
             action_std_min=.15,
             epochs=80,
+            target_kl=None,
             epsilon_clip=.2,
             memory_gamma=.95,
             memory_prune=100,
+            gae_lambda=None,
             actor_lr=3e-4,
             critic_lr=1e-3,
             lr_gamma=1,
@@ -436,6 +717,14 @@ class PPO(nn.Module):
             update_minibatch=int(1e4),
             update_load_level='minibatch',
             update_cast_level='minibatch',
+            update_shuffle=False,
+            update_prefetch=0,
+            update_pipeline=False,
+            use_autocast=False,
+            memory_backend='columnar',
+            memory_capacity=None,
+            memory_dir=None,
+            memory_compression=None,
             rs_nset=1e5,
             device='cpu',
             **kwargs,
@@ -447,9 +736,11 @@ class PPO(nn.Module):
         self.action_std_decay = action_std_decay
         self.action_std_min = action_std_min
         self.epochs = epochs
+        self.target_kl = target_kl
         self.epsilon_clip = epsilon_clip
         self.memory_gamma = memory_gamma
         self.memory_prune = memory_prune
+        self.gae_lambda = gae_lambda
 
         # Runtime management
         self.split_args = {
@@ -463,6 +754,10 @@ class PPO(nn.Module):
         self.update_minibatch = update_minibatch
         self.update_load_level = update_load_level
         self.update_cast_level = update_cast_level
+        self.update_shuffle = update_shuffle
+        self.update_prefetch = update_prefetch
+        self.update_pipeline = update_pipeline
+        self.use_autocast = use_autocast
         self.device = device
 
         # New policy
@@ -481,7 +776,23 @@ class PPO(nn.Module):
         self.scheduler = torch.optim.lr_scheduler.ExponentialLR(self.optimizer, gamma=lr_gamma)
 
         # Memory
-        self.memory = AdvancedMemoryBuffer(sum(modal_dims), rs_nset=rs_nset, split_args=self.split_args)
+        # NOTE: `columnar` is the default so that per-step rewards are written into preallocated device columns, not appended to lists
+        memory_class = {'list': AdvancedMemoryBuffer, 'columnar': ColumnarMemoryBuffer, 'memmap': MemmapMemoryBuffer}[memory_backend]
+        memory_kwargs = {'rs_nset': rs_nset, 'split_args': self.split_args, 'state_compression': memory_compression}
+        if memory_class is not AdvancedMemoryBuffer: memory_kwargs['capacity'] = memory_capacity
+        if memory_class is MemmapMemoryBuffer: memory_kwargs['directory'] = memory_dir
+        self.memory = memory_class(sum(modal_dims), **memory_kwargs)
+        if self.update_pipeline:
+            # Rollouts are recorded here while an update runs, reward statistics are shared
+            self.memory_spare = memory_class(sum(modal_dims), **memory_kwargs)
+            self.memory_spare.running_statistics = self.memory.running_statistics
+
+        # Pipelining
+        self.policy_lock = threading.Lock()  # Guards old policy weights
+        self.update_thread = None
+        self.update_exception = None
+        self.update_statistics = {}
+        self.synchronized = False  # Optimizer state is only broadcast on the first distributed update
 
         # Copy current weights
         self.update_old_policy()
@@ -496,24 +807,61 @@ class PPO(nn.Module):
 
     ### Utility functions
     def update_old_policy(self):
-        self.actor_old.load_state_dict(self.actor.state_dict())
-        self.critic_old.load_state_dict(self.critic.state_dict())
+        with self.policy_lock:
+            self.actor_old.load_state_dict(self.actor.state_dict())
+            self.critic_old.load_state_dict(self.critic.state_dict())
+
+    def autocast(self):
+        "Context for running policy networks in bfloat16, if enabled"
+        # NOTE: Distributions, losses, and reward statistics should be computed outside in float32
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.use_autocast)
 
     def decay_action_std(self):
         self.action_std = max(self.action_std - self.action_std_decay, self.action_std_min)
         self.actor.set_action_std(self.action_std)
         self.actor_old.set_action_std(self.action_std)
 
+    def training_state_dict(self, include_memory=False):
+        "Get full training state, optionally including recorded memories"
+        ret = {
+            'policy': self.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'action_std': self.action_std,
+            'running_statistics': self.memory.running_statistics.state_dict(),
+        }
+        if include_memory:
+            ret['memory'] = self.memory.state_dict()
+            if self.update_pipeline: ret['memory_spare'] = self.memory_spare.state_dict()
+        return ret
+
+    def load_training_state_dict(self, state_dict):
+        "Load full training state from `training_state_dict`"
+        if 'policy' in state_dict: self.load_state_dict(state_dict['policy'])
+        self.optimizer.load_state_dict(state_dict['optimizer'])
+        self.scheduler.load_state_dict(state_dict['scheduler'])
+        self.action_std = state_dict['action_std']
+        self.memory.running_statistics.load_state_dict(state_dict['running_statistics'])
+        if 'memory' in state_dict: self.memory.load_state_dict(state_dict['memory'])
+        if 'memory_spare' in state_dict and self.update_pipeline: self.memory_spare.load_state_dict(state_dict['memory_spare'])
+
     ### Running functions
     def act(self, *state, return_all=False):
         # Add dimension if only one shape
         if len(state[0].shape) == 1:
             state = [s.unsqueeze[0] for s in state]
 
+        # Use pre-update weights if the learner may be running
+        # NOTE: Old weights are identical to current weights outside of updates
+        actor, critic = (self.actor_old, self.critic_old) if self.update_pipeline else (self.actor, self.critic)
+
         # Calculate actions and state
-        actions = self.actor.calculate_actions(state)
-        action, action_log = self.actor.select_action(actions)
-        state_val = self.critic.evaluate_state(state)
+        with self.policy_lock:
+            with self.autocast():
+                actions = actor.calculate_actions(state)
+                state_val = critic.evaluate_state(state)
+            action, action_log = actor.select_action(actions.float())
+            state_val = state_val.float()
 
         if return_all: return action, action_log, state_val
         return action
@@ -575,119 +923,268 @@ class PPO(nn.Module):
         return action
 
     ### Backward functions
-    def update(self):
-        # Calculate rewards
-        rewards = self.memory.propagate_rewards(gamma=self.memory_gamma, prune=self.memory_prune)
-        if self.memory_prune is not None: rewards, rewards_mask = rewards
-        else: rewards_mask = torch.ones(len(rewards), dtype=bool)
-        rewards, rewards_mask = rewards.detach(), rewards_mask.detach()
-
-        # Batch parameters
-        level_dict = {'maxbatch': 0, 'batch': 1, 'minibatch': 2}
-        load_level = level_dict[self.update_load_level]  # 0, 1, 2 : max, batch, mini
-        cast_level = level_dict[self.update_cast_level]  # 0, 1, 2 : max, batch, mini
-        assert cast_level >= load_level, 'Cannot cast without first loading'
+    def update_async(self):
+        "Update in a background thread, recording new rollouts to the spare memory buffer meanwhile"
+        assert self.update_pipeline, '`update_pipeline` must be set to use `update_async`'
+        # NOTE: Collectives would be issued from the learner thread while rank 0 keeps collecting rollouts
+        assert not (dist.is_available() and dist.is_initialized()), '`update_pipeline` is not supported with distributed updates'
+
+        # Only allow one update in flight (max one update of off-policy lag)
+        self.wait_update()
+
+        # Swap memory buffers
+        memory = self.memory
+        self.memory, self.memory_spare = self.memory_spare, memory
+
+        # Start learner
+        # NOTE: The seed is drawn here so that the learner never touches the global random state
+        seed = np.random.randint(2**31)
+        def update_target():
+            try: self.update(memory=memory, seed=seed)
+            except BaseException as e: self.update_exception = e
+        self.update_thread = threading.Thread(target=update_target, daemon=True)
+        self.update_thread.start()
+
+    def is_updating(self):
+        "Check if an `update_async` call is still running"
+        return self.update_thread is not None and self.update_thread.is_alive()
+
+    def wait_update(self):
+        "Wait for an in-flight `update_async` call to finish"
+        if self.update_thread is None: return
+        self.update_thread.join()
+        self.update_thread = None
+
+        # Raise learner errors in the calling thread
+        if self.update_exception is not None:
+            exception, self.update_exception = self.update_exception, None
+            raise exception
+
+    def synchronize(self, maxbatch=None, stop=False):
+        "Broadcast compressed memories with maxbatch indices and targets, weights, and a sampling seed from rank 0. Returns `None` on stop"
+        # NOTE: All ranks run on CPU (gloo), so tensors are never pickled across devices
+        assert torch.device(self.device).type == 'cpu', 'Distributed updates require the policy to be on CPU'
+
+        # Broadcast maxbatch, training state, and sampling seed
+        # NOTE: Memories are sent compressed, optimizer state is only sent once, after which all ranks take identical steps
+        rank = dist.get_rank()
+        payload = [stop, None, np.random.randint(2**31)]
+        if rank != 0: payload = [None, None, None]
+        elif not stop:
+            payload[1] = {
+                'maxbatch': utilities.snapshot_tensors(maxbatch),  # Compact column views before pickling
+                'action_std': self.action_std}
+            if not self.synchronized:
+                payload[1]['optimizer'] = self.optimizer.state_dict()
+                payload[1]['scheduler'] = self.scheduler.state_dict()
+        dist.broadcast_object_list(payload, src=0)
+        stop, training_state, seed = payload
+        if stop: return None
+        self.synchronized = True
+
+        # Broadcast weights
+        for v in self.state_dict().values(): dist.broadcast(v, src=0)
+
+        # Load training state
+        if rank != 0:
+            self.action_std = training_state['action_std']
+            if 'optimizer' in training_state:
+                self.optimizer.load_state_dict(training_state['optimizer'])
+                self.scheduler.load_state_dict(training_state['scheduler'])
+
+        return training_state['maxbatch'], seed
+
+    def serve_updates(self):
+        "Participate in distributed updates led by rank 0 until `stop_updates` is called"
+        assert dist.get_rank() != 0, '`serve_updates` must not be called from rank 0'
+        while (synchronized := self.synchronize()) is not None:
+            self.update(maxbatch=synchronized[0], seed=synchronized[1])
+
+    def stop_updates(self):
+        "Release ranks waiting in `serve_updates`"
+        if dist.is_available() and dist.is_initialized(): self.synchronize(stop=True)
+
+    def update(self, memory=None, maxbatch=None, seed=None):
+        "Update from `memory`, or from memories and a `maxbatch` broadcast by rank 0 on other ranks"
+        # Defaults
+        if memory is None: memory = self.memory
+
+        # Distributed parameters
+        # NOTE: Each rank computes gradients for a deterministic shard of each minibatch
+        distributed = dist.is_available() and dist.is_initialized()
+        rank, world_size = (dist.get_rank(), dist.get_world_size()) if distributed else (0, 1)
+
+        # Sampling randomness
+        # NOTE: Seeded generators give identical sampling across ranks, and keep pipelined updates reproducible
+        rng = np.random.default_rng(seed) if seed is not None else np.random
+        memory.rng = rng if seed is not None else None
+
+        # Choose maxbatch
+        if maxbatch is None:
+            # Calculate value targets and advantages
+            returns, advantages, targets_mask = memory.estimate_advantages(
+                gamma=self.memory_gamma, gae_lambda=self.gae_lambda, prune=self.memory_prune)
+            targets = torch.stack((returns, advantages), dim=-1).detach()
+
+            # Sample
+            memory_size = sum(targets_mask)
+            maxbatch_size = self.update_maxbatch if self.update_maxbatch is not None else memory_size
+            maxbatch_size = int(min(maxbatch_size, memory_size))
+            maxbatch_idx = rng.choice(
+                np.arange(len(memory))[targets_mask],  # Only consider states which have rewards with significant future samples
+                maxbatch_size,
+                replace=False,
+            )
+
+            # Send compressed memories and the sampled maxbatch to other ranks
+            if distributed:
+                _, seed = self.synchronize({'memory': memory.state_dict(), 'maxbatch_idx': maxbatch_idx, 'targets': targets})
+                rng = np.random.default_rng(seed)
+
+        # Load compressed memories broadcast by rank 0
+        # NOTE: Memories are only reconstructed at `update_load_level`, so each rank expands its own minibatch shards
+        else:
+            memory.load_state_dict(maxbatch['memory'])
+            maxbatch_idx, targets = maxbatch['maxbatch_idx'], maxbatch['targets']
+            maxbatch_size = len(maxbatch_idx)
 
         # Determine batch sizes
-        memory_size = sum(rewards_mask)
-        maxbatch_size = self.update_maxbatch if self.update_maxbatch is not None else memory_size
-        maxbatch_size = int(min(maxbatch_size, memory_size))
         batch_size = self.update_batch if self.update_batch is not None else maxbatch_size
         batch_size = int(min(batch_size, maxbatch_size))
         minibatch_size = self.update_minibatch if self.update_minibatch is not None else batch_size
         minibatch_size = int(min(minibatch_size, batch_size))
 
+        # Stage memories, loading and casting at the configured levels
+        # NOTE: When prefetching, casts are copied from pinned memory without blocking
+        sampler = utilities.Sampler(
+            memory, targets, self.update_load_level, self.update_cast_level, self.device,
+            non_blocking=self.update_prefetch > 0, num_buffers=self.update_prefetch + 2)
+
         # Load maxbatch
-        maxbatch_idx = np.random.choice(
-            np.arange(len(self.memory))[rewards_mask],  # Only consider states which have rewards with significant future samples
-            maxbatch_size,
-            replace=False,
-        )
-        if load_level == 0:
-            maxbatch_data = self.memory[maxbatch_idx]
-            maxbatch_rewards = rewards[maxbatch_idx]
-        if cast_level == 0:
-            maxbatch_data = utilities.dict_map_recursive_tensor_idx_to(maxbatch_data, None, self.device)
-            maxbatch_rewards = maxbatch_rewards.to(self.device)
+        sampler.stage('maxbatch', maxbatch_idx)
 
-        # Train
+        # Choose batches for all epochs
+        epoch_batches = []
         for _ in range(self.epochs):
-            # Load batch
-            batch_idx = np.random.choice(maxbatch_size, batch_size, replace=False)
-            batch_absolute_idx = maxbatch_idx[batch_idx]
-            if load_level == 1:
-                batch_data = self.memory[batch_absolute_idx]
-                batch_rewards = rewards[batch_absolute_idx]
-            elif load_level < 1:
-                batch_data = utilities.dict_map_recursive_tensor_idx_to(maxbatch_data, batch_idx, None)
-                batch_rewards = maxbatch_rewards[batch_idx]
-            if cast_level == 1:
-                batch_data = utilities.dict_map_recursive_tensor_idx_to(batch_data, None, self.device)
-                batch_rewards = batch_rewards.to(self.device)
-
-            # Gradient accumulation
-            for _, min_idx in enumerate(range(0, batch_size, minibatch_size)):
-                # Load minibatch
-                max_idx = min(min_idx + minibatch_size, batch_size)
-                minibatch_idx = np.arange(min_idx, max_idx)
-                minibatch_absolute_idx = batch_absolute_idx[minibatch_idx]
-                if load_level == 2:
-                    minibatch_data = self.memory[minibatch_absolute_idx]
-                    minibatch_rewards = rewards[minibatch_absolute_idx]
-                if load_level < 2:
-                    minibatch_data = utilities.dict_map_recursive_tensor_idx_to(batch_data, minibatch_idx, None)
-                    minibatch_rewards = batch_rewards[minibatch_idx]
-                if cast_level == 2:
-                    minibatch_data = utilities.dict_map_recursive_tensor_idx_to(minibatch_data, None, self.device)
-                    minibatch_rewards = minibatch_rewards.to(self.device)
-
-                # Get subset data
-                states_old_sub = minibatch_data['states']
-                actions_old_sub = minibatch_data['actions']
-                action_logs_old_sub = minibatch_data['action_logs']
-                state_vals_old_sub = minibatch_data['state_vals']
-
-                # Get subset rewards
-                advantages_sub = minibatch_rewards - state_vals_old_sub
-
-                # Evaluate actions
-                action_logs, dist_entropy = self.actor.evaluate_action(states_old_sub, actions_old_sub)
-
-                # Evaluate states
-                state_vals = self.critic.evaluate_state(states_old_sub)
-
-                # Ratio between new and old probabilities
-                ratios = torch.exp(action_logs - action_logs_old_sub)
-
-                # Calculate PPO loss
-                unclipped = ratios * advantages_sub
-                clipped = torch.clamp(ratios, 1-self.epsilon_clip, 1+self.epsilon_clip) * advantages_sub
-                loss_PPO = -torch.min(unclipped, clipped)
-
-                # Calculate critic loss
-                loss_critic = .5 * F.mse_loss(state_vals, minibatch_rewards)
-
-                # Calculate entropy loss
-                # TODO (Minor): Figure out purpose
-                loss_entropy = -.01 * dist_entropy
-
-                # CLI
-                # print(f'Epoch {epoch+1:02} - Minibatch {minibatch+1:01}')
-                # print(f'PPO: {loss_PPO.mean():.3f}, critic: {loss_critic.mean():.3f}, entropy: {loss_entropy.mean():.3f}')
-                # print()
-
-                # Calculate total loss
-                loss = loss_PPO + loss_critic + loss_entropy
-                loss = loss.mean()
-
-                # Scale and calculate gradient
-                accumulation_frac = (max_idx - min_idx) / batch_size
-                loss = loss * accumulation_frac
-                loss.backward()  # Longest computation
-
-            # Step
-            self.optimizer.step()
-            self.optimizer.zero_grad()
+            if self.update_shuffle:
+                # Iterate over one permutation of the maxbatch
+                permutation = rng.permutation(maxbatch_size)
+                epoch_batches.append([permutation[i:i+batch_size] for i in range(0, maxbatch_size, batch_size)])
+            else: epoch_batches.append([sampler.sample('batch', batch_size, rng=rng)])
+
+        # Split batches into minibatches, sharded across ranks
+        def get_minibatch_idx(batch_len):
+            for min_idx in range(0, batch_len, minibatch_size):
+                max_idx = min(min_idx + minibatch_size, batch_len)
+                minibatch_idx = np.array_split(np.arange(min_idx, max_idx), world_size)[rank]
+                if len(minibatch_idx) > 0: yield minibatch_idx  # Skip if more ranks than memories
+
+        # Load minibatches in training order
+        def load_minibatches():
+            for batch_idx in sum(epoch_batches, []):
+                sampler.stage('batch', batch_idx)
+                for minibatch_idx in get_minibatch_idx(len(batch_idx)):
+                    yield sampler.stage('minibatch', minibatch_idx)
+        minibatches = utilities.Prefetcher(load_minibatches(), depth=self.update_prefetch)
+
+        # Train
+        epochs_run, steps_run, approx_kl, stop_early = 0, 0, None, False
+        # NOTE: Prefetching is stopped even if the update fails
+        try:
+            for epoch_batch_idx in epoch_batches:
+                for batch_idx in epoch_batch_idx:
+                    # Gradient accumulation
+                    batch_len = len(batch_idx)
+                    batch_kl = torch.zeros((), device=self.device)
+                    for minibatch_idx in get_minibatch_idx(batch_len):
+                        # Get prepared minibatch
+                        minibatch_data = next(minibatches)
+
+                        # Get subset data
+                        states_old_sub = minibatch_data['states']
+                        actions_old_sub = minibatch_data['actions']
+                        action_logs_old_sub = minibatch_data['action_logs']
+                        state_vals_old_sub = minibatch_data['state_vals']
+
+                        # Get subset targets
+                        returns_sub, advantages_sub = minibatch_data['targets'][:, 0], minibatch_data['targets'][:, 1]
+
+                        # Evaluate actions and states
+                        with self.autocast():
+                            actions_sub = self.actor.calculate_actions(states_old_sub)
+                            state_vals = self.critic.evaluate_state(states_old_sub)
+                        action_logs, dist_entropy = self.actor.select_action(actions_sub.float(), action=actions_old_sub, return_entropy=True)
+                        state_vals = state_vals.float()
+
+                        # Ratio between new and old probabilities
+                        log_ratios = action_logs - action_logs_old_sub
+                        ratios = torch.exp(log_ratios)
+
+                        # Approximate KL divergence from old policy (http://joschu.net/blog/kl-approx.html)
+                        batch_kl += ((ratios - 1) - log_ratios).detach().sum()
+
+                        # Calculate PPO loss
+                        unclipped = ratios * advantages_sub
+                        clipped = torch.clamp(ratios, 1-self.epsilon_clip, 1+self.epsilon_clip) * advantages_sub
+                        loss_PPO = -torch.min(unclipped, clipped)
+
+                        # Calculate critic loss
+                        loss_critic = .5 * F.mse_loss(state_vals, returns_sub)
+
+                        # Calculate entropy loss
+                        # TODO (Minor): Figure out purpose
+                        loss_entropy = -.01 * dist_entropy
+
+                        # CLI
+                        # print(f'Epoch {epoch+1:02} - Minibatch {minibatch+1:01}')
+                        # print(f'PPO: {loss_PPO.mean():.3f}, critic: {loss_critic.mean():.3f}, entropy: {loss_entropy.mean():.3f}')
+                        # print()
+
+                        # Calculate total loss
+                        loss = loss_PPO + loss_critic + loss_entropy
+                        loss = loss.mean()
+
+                        # Scale and calculate gradient
+                        accumulation_frac = len(minibatch_idx) / batch_len
+                        loss = loss * accumulation_frac
+                        loss.backward()  # Longest computation
+
+                    # Stop before stepping if policy has moved too far from old policy
+                    # NOTE: The first step is always taken, as redrawn neighbors make the initial KL nonzero with `max_nodes`
+                    if distributed: dist.all_reduce(batch_kl)
+                    approx_kl = batch_kl.item() / batch_len
+                    if self.target_kl is not None and steps_run > 0 and approx_kl > self.target_kl:
+                        self.optimizer.zero_grad()
+                        stop_early = True
+                        break
+
+                    # Sum gradients across ranks
+                    if distributed:
+                        handles = []
+                        for group in self.optimizer.param_groups:
+                            for p in group['params']:
+                                if not p.requires_grad: continue
+                                if p.grad is None: p.grad = torch.zeros_like(p)
+                                handles.append(dist.all_reduce(p.grad, async_op=True))
+                        for handle in handles: handle.wait()
+
+                    # Step
+                    self.optimizer.step()
+                    self.optimizer.zero_grad()
+                    steps_run += 1
+
+                # Early stopping
+                if stop_early: break
+                epochs_run += 1
+        finally: minibatches.close()
+
+        # Record statistics
+        self.update_statistics = {
+            'epochs': epochs_run,
+            'steps': steps_run,
+            'approx_kl': approx_kl,
+            **{f'time_{k}': v for k, v in sampler.timings.items()},
+        }
 
         # Update scheduler
         self.scheduler.step()
@@ -696,4 +1193,14 @@ class PPO(nn.Module):
         self.update_old_policy()
 
         # Clear memory
-        self.memory.clear()
+        memory.rng = None
+        memory.clear()
+
+
+def distributed_update_worker(rank, world_size, init_method, policy_kwargs, num_threads=None):
+    "Entrypoint for non-zero ranks of a CPU data-parallel (gloo) policy update"
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+    if num_threads is not None: torch.set_num_threads(num_threads)
+    policy = PPO(**policy_kwargs).train()
+    policy.serve_updates()
+    dist.destroy_process_group()
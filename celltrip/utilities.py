@@ -1,5 +1,12 @@
 from collections import defaultdict, deque
+import concurrent.futures
+import copy
+import hashlib
 from itertools import product
+import json
+import os
+import queue
+import threading
 from time import perf_counter
 import tracemalloc
 import warnings
@@ -248,6 +255,78 @@ class EarlyStopping:
         "Calculate threshold for improvement"
         self.threshold = self.best + (-1 if self.decreasing else 1) * self.delta
 
+    def state_dict(self):
+        "Get state variables"
+        return {
+            'history': list(self.history),
+            'current': self.current,
+            'best': self.best,
+            'threshold': self.threshold,
+            'lapses': self.lapses,
+        }
+
+    def load_state_dict(self, state_dict):
+        "Load state variables"
+        self.history.clear()
+        self.history.extend(state_dict['history'])
+        for k in ('current', 'best', 'threshold', 'lapses'): setattr(self, k, state_dict[k])
+
+
+def atomic_save(obj, fname):
+    "Save `obj` with `torch.save` such that `fname` is never partially written"
+    tmp_fname = f'{fname}.tmp'
+    torch.save(obj, tmp_fname)
+    os.replace(tmp_fname, fname)
+
+
+def snapshot_tensors(obj):
+    "Recursively copy `obj`, with tensors copied to CPU"
+    if torch.is_tensor(obj): return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict): return {k: snapshot_tensors(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)): return type(obj)(snapshot_tensors(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class CheckpointWriter:
+    "Write checkpoints atomically in a background thread"
+    def __init__(self):
+        self.thread = None
+        self.exception = None
+        self.snapshot_event = None
+
+    def save(self, obj, fname):
+        "Snapshot and write `obj` in the background, call `wait_snapshot` before modifying its tensors in place"
+        # Wait for previous write
+        self.wait()
+
+        # Snapshot, then write in background
+        # NOTE: Containers in `obj` must not be modified by the caller afterwards
+        self.snapshot_event = threading.Event()
+        def save_target():
+            try:
+                snapshot = snapshot_tensors(obj)
+                self.snapshot_event.set()
+                atomic_save(snapshot, fname)
+            except BaseException as e: self.exception = e
+            finally: self.snapshot_event.set()
+        self.thread = threading.Thread(target=save_target)
+        self.thread.start()
+
+    def wait_snapshot(self):
+        "Wait until the in-progress write no longer reads from live tensors"
+        if self.snapshot_event is not None: self.snapshot_event.wait()
+
+    def wait(self):
+        "Wait for in-progress write to finish"
+        if self.thread is None: return
+        self.thread.join()
+        self.thread = None
+
+        # Raise write errors in the calling thread
+        if self.exception is not None:
+            exception, self.exception = self.exception, None
+            raise exception
+
 
 def clean_return(ret, keep_array=False):
     "Clean return output for improved parsing"
@@ -280,9 +359,9 @@ def split_state(
     node_mask = ~node_mask
 
     # Enforce reproducibility
-    if reproducible_strategy is not None:
-        # Save old random seed
-        seed_old = torch.seed()
+    # NOTE: A local generator is used so that the global random state is left
+    # untouched and concurrent calls (i.e. pipelined updates) don't interfere
+    generator = None
 
     # Hashing method
     if reproducible_strategy is None:
@@ -290,13 +369,13 @@ def split_state(
 
     elif reproducible_strategy == 'hash':
         # Set new random state
-        torch.manual_seed(hash(state))
+        generator = torch.Generator(device=state.device).manual_seed(hash(state))
 
     # Set seed (not recommended)
     # TODO: Is there a better way to do this?
     elif type(reproducible_strategy) != str:
         # Set new random state
-        torch.manual_seed(reproducible_strategy)
+        generator = torch.Generator(device=state.device).manual_seed(reproducible_strategy)
 
     else:
         raise ValueError(f'Reproducible strategy \'{reproducible_strategy}\' not found.')
@@ -311,7 +390,7 @@ def split_state(
         # Random sample `num_nodes` to `max_nodes`
         if sample_strategy == 'random':
             # Filter nodes to `max_nodes` per idx
-            probs = torch.rand_like(node_mask, dtype=torch.get_default_dtype())
+            probs = torch.rand(node_mask.shape, generator=generator, device=state.device).to(node_mask.device)
             probs[~node_mask] = 0
             selected_idx = probs.argsort(dim=-1)[..., -num_nodes:]  # Take `num_nodes` highest values
 
@@ -353,17 +432,13 @@ def split_state(
             node_mask = torch.zeros((len(self_idx), state.shape[0]), dtype=torch.bool)
             for i in range(node_mask.shape[0]):
                 # TODO: Fix syntax
-                idx = prob[self_idx[i]].multinomial(num_nodes, replacement=False)
+                idx = prob[self_idx[i]].multinomial(num_nodes, replacement=False, generator=generator)
                 node_mask[i, idx] = True
 
         else:
             # TODO: Verify works
             raise ValueError(f'Sample strategy \'{sample_strategy}\' not found.')
 
-    # Revert random changes
-    if reproducible_strategy is not None:
-        torch.manual_seed(seed_old)
-    
     # Final formation
     node_entities = state.unsqueeze(0).expand(len(self_idx), *state.shape)
     node_entities = node_entities[node_mask].reshape(len(self_idx), num_nodes, state.shape[1])
@@ -400,14 +475,16 @@ def dict_map(dict, func, inplace=False):
         return {k: func(v) for k, v in dict.items()}
     
 
-def dict_map_recursive_tensor_idx_to(dict, idx, device):
+def dict_map_recursive_tensor_idx_to(dict, idx, device, non_blocking=False):
     "Take `idx` and cast to `device` from tensors inside of a dict, recursively"
     # NOTE: List indices into tensors create a copy
     # TODO: Add slice compatibility
     # Define function for each member
     def subfunc(x):
         if idx is not None: x = x[idx]
-        if device is not None: x = x.to(device)
+        if device is not None:
+            # NOTE: Copies are only asynchronous from pinned host memory
+            x = x.to(device, non_blocking=non_blocking)
         return x
     
     # Apply and return (if needed)
@@ -442,9 +519,77 @@ def h5_tree(val, pre=''):
                     print(pre + '├── ' + key + ' (scalar)')
 
 
+class Prefetcher:
+    "Iterate over `iterable` in a background thread, keeping up to `depth` items ready"
+    def __init__(self, iterable, depth=1):
+        # Parameters
+        self.iterator = iter(iterable)
+        self.depth = depth  # Iterate synchronously if 0
+
+        # Background thread
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.stop_event = threading.Event()
+        self.thread = None
+        if depth > 0:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.thread is None: return next(self.iterator)
+
+        # Get prepared item, raising exceptions from the thread
+        finished, item = self.queue.get()
+        if finished:
+            self.close()
+            if item is not None: raise item
+            raise StopIteration
+        return item
+
+    def _run(self):
+        "Fill the queue until the iterator is exhausted or prefetching is stopped"
+        try:
+            for item in self.iterator:
+                if not self._put((False, item)): return
+        except Exception as err:
+            self._put((True, err))
+            return
+        self._put((True, None))
+
+    def _put(self, item):
+        "Put `item` on the queue, returning `False` if stopped"
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=.1)
+                return True
+            except queue.Full: pass
+        return False
+
+    def close(self):
+        "Stop prefetching and wait for the background thread"
+        self.stop_event.set()
+        if self.thread is not None: self.thread.join()
+
+
+class TensorDictSource:
+    "Indexable dict of tensors (or lists of tensors) sharing a first dim, usable as `Sampler` memory"
+    def __init__(self, data):
+        self.data = data
+        first = next(iter(data.values()))
+        self.length = (first[0] if isinstance(first, (list, tuple)) else first).shape[0]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        return dict_map_recursive_tensor_idx_to(self.data, torch.as_tensor(idx, dtype=torch.long), None)
+
+
 class Sampler:
-    "Sampler for data from `AdvancedMemoryBuffer`"
-    def __init__(self, memory, rewards, sizes, mem_stage, gpu_stage, device):
+    "Staged maxbatch, batch, and minibatch loader for data from `AdvancedMemoryBuffer`"
+    def __init__(self, memory, targets, load_stage, cast_stage, device, non_blocking=False, num_buffers=2):
         # Constants
         self.stage_dict = {
             'maxbatch': 0,
@@ -454,93 +599,87 @@ class Sampler:
 
         # Parameters and data
         self.memory = memory
-        self.rewards = rewards
-        self.sizes = sizes
-        self.mem_stage = self.stage_dict[mem_stage]
-        self.gpu_stage = self.stage_dict[gpu_stage]
+        self.targets = targets
+        self.load_stage = self.stage_dict[load_stage]
+        self.cast_stage = self.stage_dict[cast_stage]
+        assert self.cast_stage >= self.load_stage, 'Cannot cast without first loading'
         self.device = device
+        self.non_blocking = non_blocking
+        self.pin = non_blocking and torch.device(device).type == 'cuda'  # Cast from reused pinned buffers
+        self.num_buffers = num_buffers  # Staging buffers per stage, rotated so that consumed data isn't overwritten
 
         # Variables
-        self.idxs = [[] for _ in range(len(self.sizes))]
-        self.mem_data = None
-        self.mem_rewards = None
-        self.gpu_data = None
-        self.gpu_rewards = None
-
-    def sample(self, stage, idx=None):
-        # Determine where to sample from
-        if stage == 0:
-            # First stage samples from all memories
-            sample_from = len(self.memory)
-        elif (stage - 1) in (self.mem_stage, self.gpu_stage):
-            # Stage after loading into memory resets indexes
-            sample_from = len(self.idxs[stage-1])
-        else:
-            # Otherwise, sample from previous idx
-            sample_from = self.idxs[stage - 1]
-
-        # Set idx manually
-        if idx is not None:
-            # Make list if int
-            if type(sample_from) == int: sample_from = np.array(range(sample_from))
-            # Sample
-            self.idxs[stage] = sample_from[idx]
-
-        # Randomly sample idx
-        self.idxs[stage] = np.random.choice(sample_from, self.sizes[stage])
-        
-    def act(self, stage):
-        if stage == self.mem_stage:
-            # Load into memory
-            self.mem_data = self.memory[self.idxs[stage]]
-            self.mem_rewards = self.rewards[self.idxs[stage]]
-        
-        if stage == self.gpu_stage:
-            # Load into GPU
-            if stage == self.mem_stage:
-                self.gpu_data = dict_map_recursive_tensor_idx_to(self.mem_data, None, self.device)
-                self.gpu_rewards = self.mem_rewards.to(self.device)
-            else:
-                self.gpu_data = dict_map_recursive_tensor_idx_to(self.mem_data, self.idxs[stage], self.device)
-                self.gpu_rewards = self.mem_rewards[self.idxs[stage]].to(self.device)
-
-        # Return latest data
-        # print(stage)
-        # torch.cuda.synchronize()
-        # torch.cuda.reset_peak_memory_stats()
-        # print(f'{torch.cuda.max_memory_allocated() / 1024**3:.2f} GB')
-        if stage >= self.gpu_stage:
-            if stage == self.gpu_stage:
-                data = self.gpu_data
-                rewards = self.gpu_rewards
-            else:
-                data = dict_map_recursive_tensor_idx_to(self.gpu_data, self.idxs[stage], None)
-                rewards = self.gpu_rewards[self.idxs[stage]]
-        elif stage >= self.mem_stage:
-            if stage == self.mem_stage:
-                data = self.mem_data
-                rewards = self.mem_rewards
-            else:
-                data = dict_map_recursive_tensor_idx_to(self.mem_data, self.idxs[stage], None)
-                rewards = self.mem_rewards[self.idxs[stage]]
-        else:
-            data = None
-            rewards = self.rewards[self.idxs[stage]]
-        # torch.cuda.synchronize()
-        # torch.cuda.reset_peak_memory_stats()
-        # print(f'{torch.cuda.max_memory_allocated() / 1024**3:.2f} GB')
-        # print()
-
-        return data, rewards
-
-    def stage(self, stage, **kwargs):
-        # Convert stage to int
+        self.idxs = [None for _ in self.stage_dict]  # Absolute memory indices of each stage
+        self.data = [None for _ in self.stage_dict]  # Data of each stage, if loaded
+        self.buffers = [[{} for _ in range(num_buffers)] for _ in self.stage_dict]
+        self.buffer_nums = [0 for _ in self.stage_dict]
+        self.copy_events = [[None for _ in range(num_buffers)] for _ in self.stage_dict]  # Pending copies out of pinned buffers
+        self.timings = defaultdict(lambda: 0.)  # Seconds spent per stage and action
+
+    def sample(self, stage, size, rng=np.random):
+        "Choose `size` indices of the previous stage without replacement"
         stage = self.stage_dict[stage]
+        sample_from = len(self.memory) if stage == 0 else len(self.idxs[stage-1])
+        return rng.choice(sample_from, size, replace=False)
+
+    def stage(self, stage, idx):
+        "Select `idx` from the previous stage (or memory), returning the data if loaded"
+        stage_name, stage = stage, self.stage_dict[stage]
+        self.idxs[stage] = idx if stage == 0 else self.idxs[stage-1][idx]
+        data = None
+
+        # Load into memory, or reuse loaded data
+        if stage == self.load_stage:
+            start = perf_counter()
+            data = {**self.memory[self.idxs[stage]], 'targets': self.targets[self.idxs[stage]]}
+            if self.pin and stage == self.cast_stage: data = self._map_buffers(stage, data, lambda x, buffer: buffer.copy_(x))
+            self.timings[f'{stage_name}_load'] += perf_counter() - start
+        elif stage > self.load_stage:
+            start = perf_counter()
+            data = self._index(stage, self.data[stage-1], idx)
+            self.timings[f'{stage_name}_index'] += perf_counter() - start
+
+        # Cast to device
+        # NOTE: Non-blocking casts are only timed until enqueued
+        if stage == self.cast_stage:
+            start = perf_counter()
+            data = dict_map_recursive_tensor_idx_to(data, None, self.device, non_blocking=self.non_blocking)
+            if self.pin:
+                self.copy_events[stage][(self.buffer_nums[stage] - 1) % self.num_buffers] = event = torch.cuda.Event()
+                event.record()
+            self.timings[f'{stage_name}_cast'] += perf_counter() - start
+
+        self.data[stage] = data
+        return data
+
+    def _index(self, stage, data, idx):
+        "Index the first dim of tensors in `data` into the next preallocated buffers of `stage`"
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        return self._map_buffers(stage, data, lambda x, buffer: torch.index_select(x, 0, idx.to(x.device), out=buffer), num_rows=len(idx))
+
+    def _map_buffers(self, stage, data, func, num_rows=None):
+        "Apply `func(x, buffer)` to tensors in `data`, writing into the next preallocated buffers of `stage`"
+        num = self.buffer_nums[stage] % self.num_buffers
+        buffers = self.buffers[stage][num]
+        self.buffer_nums[stage] += 1
+
+        # Wait for casts still reading from these buffers
+        if self.copy_events[stage][num] is not None:
+            self.copy_events[stage][num].synchronize()
+            self.copy_events[stage][num] = None
+
+        # Allocate buffers when their row capacity is exceeded or layout changes, pinned if cast from this stage
+        def subfunc(name, x):
+            rows = num_rows if num_rows is not None else x.shape[0]
+            buffer = buffers.get(name)
+            if buffer is None or buffer.shape[0] < rows or buffer.shape[1:] != x.shape[1:] or buffer.dtype != x.dtype or buffer.device != x.device:
+                pin = self.pin and stage == self.cast_stage and x.device.type == 'cpu'
+                buffers[name] = buffer = torch.empty((rows, *x.shape[1:]), dtype=x.dtype, device=x.device, pin_memory=pin)
+            return func(x, buffer[:rows])
+        return {
+            k: [subfunc((k, i), x) for i, x in enumerate(v)] if not torch.is_tensor(v) else subfunc(k, v)
+            for k, v in data.items()}
 
-        # Perform actions
-        self.sample(stage, **kwargs)
-        return self.act(stage)
-    
 
 class MemoryBuffer:
     """
@@ -596,10 +735,10 @@ class RunningStatistics:
         # Params
         self.n_set = n_set
 
-    def reset(self, mean=0, m2=0):
+    def reset(self, mean=0, m2=0, n=0):
         self.mean_x = mean
         self.m2 = m2
-        self.n = 0
+        self.n = n
 
     def update(self, x):
         self.n += 1
@@ -609,6 +748,50 @@ class RunningStatistics:
         self.mean_x += delta / n
         self.m2 += delta * (x - self.mean_x)
 
+    def update_batch(self, x):
+        "Update with all samples of `x` at once, equivalent to calling `update` on each in order"
+        x = torch.as_tensor(x).flatten().double()
+        if len(x) == 0: return
+
+        # Parallel merge of batch statistics
+        if self.n_set is None:
+            self.merge(RunningStatistics(mean=x.mean(), m2=((x - x.mean())**2).sum(), n=len(x)))
+            return
+
+        # Exponential moving mean with fixed window `n_set`
+        mean_x = torch.as_tensor(self.mean_x, dtype=torch.float64)
+        m2 = torch.as_tensor(self.m2, dtype=torch.float64)
+        # m_t = decay^t (m_0 + (1 - decay) sum_s decay^-s x_s), scanned in chunks
+        # so that inverse powers of `decay` stay well conditioned
+        decay = 1 - 1 / self.n_set
+        chunk_size = len(x) if decay <= 0 else max(1, int(np.log(1e12) / -np.log(decay)))
+        for chunk in x.split(chunk_size):
+            if decay <= 0: means = chunk
+            else:
+                powers = decay ** torch.arange(1, len(chunk)+1, dtype=torch.float64)
+                means = powers * (mean_x + (1 - decay) * torch.cumsum(chunk / powers, dim=0))
+            previous = torch.concat((mean_x.reshape(1), means[:-1]))
+            m2 = m2 + decay * ((chunk - previous)**2).sum()  # delta * (x - new mean)
+            mean_x = means[-1]
+
+        self.mean_x, self.m2 = mean_x, m2
+        self.n += len(x)
+
+    def merge(self, other):
+        "Merge the statistics of another `RunningStatistics` object (Chan et al.)"
+        # NOTE: With `n_set`, means are weighted by their effective windows, which
+        # is approximate as the sequential update is order dependent
+        if other.n == 0: return
+        n_a, n_b = self.n, other.n
+        if self.n_set is not None: n_a, n_b = min(n_a, self.n_set), min(n_b, self.n_set)
+        mean_a = torch.as_tensor(self.mean_x, dtype=torch.float64)
+        mean_b = torch.as_tensor(other.mean_x, dtype=torch.float64)
+        delta = mean_b - mean_a
+        n = n_a + n_b
+        self.mean_x = mean_a + delta * n_b / n
+        self.m2 = torch.as_tensor(self.m2, dtype=torch.float64) + other.m2 + delta**2 * n_a * n_b / n
+        self.n += other.n
+
     def mean(self):
         return self.mean_x
     
@@ -617,6 +800,12 @@ class RunningStatistics:
         if n < 2: return 0
         else: return self.m2 / (self.n - 1)
 
+    def state_dict(self):
+        return {'mean_x': self.mean_x, 'm2': self.m2, 'n': self.n, 'n_set': self.n_set}
+
+    def load_state_dict(self, state_dict):
+        for k, v in state_dict.items(): setattr(self, k, v)
+
 
 def standardize_features(*MS, all=False, **kwargs):
     "Standardize given modalities by feature or by whole matrix"
@@ -653,6 +842,12 @@ def subsample_nodes(*DS, num_nodes, **kwargs):
     return clean_return(ret, **kwargs)
 
 
+def choice_without_replacement(a, size):
+    "Sample `size` entries of `a` without replacement, in time proportional to `size` rather than `len(a)`"
+    # NOTE: Generator seeded from the global RNG so `np.random.seed` stays reproducible, its `choice` avoids a full permutation
+    return a[np.random.default_rng(np.random.randint(2**31)).choice(len(a), size, replace=False)]
+
+
 class LazyComputation:
     "Lazily compute specified function once on first call"
     def __init__(self, init_func, *args, **kwargs):
@@ -666,8 +861,156 @@ class LazyComputation:
         return self.func(x)
 
 
+class PartitionIndex:
+    "Row indices for each partition group, built once for repeated episode sampling"
+    def __init__(self, partition):
+        self.groups, inverse, self.counts = np.unique(partition, return_inverse=True, return_counts=True)
+        self.index = np.split(np.argsort(inverse, kind='stable'), np.cumsum(self.counts)[:-1])
+
+    def __len__(self):
+        return len(self.groups)
+
+    def choose(self, weighted=False, num_nodes=None):
+        "Row indices of a random group, chosen uniformly or proportionally to group size, and subsampled to `num_nodes`"
+        idx = self.index[np.random.choice(len(self.groups), p=self.counts / self.counts.sum() if weighted else None)]
+        if num_nodes is None or num_nodes >= len(idx): return idx
+        return choice_without_replacement(idx, num_nodes)
+
+    def stratify(self, num_nodes=None):
+        "Row indices sampled across all groups, proportionally to group size"
+        if num_nodes is None or num_nodes >= self.counts.sum(): return np.concatenate(self.index)
+
+        # Allocate by largest remainder
+        quota = num_nodes * self.counts / self.counts.sum()
+        allocation = np.floor(quota).astype(int)
+        allocation[np.argsort(allocation - quota)[:num_nodes - allocation.sum()]] += 1
+        return np.concatenate([choice_without_replacement(idx, k) for idx, k in zip(self.index, allocation)])
+
+
+class ChunkedPCA:
+    "PCA fit over row chunks with randomized SVD or incremental updates, without densifying the whole matrix"
+    def __init__(self, n_components, solver='randomized', chunk_size=int(1e4), feature_scale=None, n_oversamples=10, n_iter=4, random_state=None):
+        self.n_components = n_components
+        self.solver = solver  # `randomized` or `incremental`
+        self.chunk_size = chunk_size
+        self.feature_scale = feature_scale  # Divides features before centering, applied per chunk
+        self.n_oversamples = n_oversamples  # Randomized only
+        self.n_iter = n_iter  # Randomized only, power iterations
+        self.random_state = random_state
+
+    def _chunks(self, X, feature_idx=None, min_size=1):
+        "Yield row offsets and dense or sparse row blocks of `X`, optionally subset to `feature_idx` and scaled"
+        num_chunks = max(1, min(int(np.ceil(X.shape[0] / self.chunk_size)), X.shape[0] // min_size))
+        bounds = np.linspace(0, X.shape[0], num_chunks+1).astype(int)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            chunk = X[start:end]
+            if feature_idx is not None: chunk = chunk[:, feature_idx]
+            if self.feature_scale is not None:
+                chunk = chunk.multiply(1 / self.feature_scale).tocsr() if scipy.sparse.issparse(chunk) else chunk / self.feature_scale
+            yield start, chunk
+
+    def fit(self, X, feature_idx=None):
+        if self.solver == 'randomized': self._fit_randomized(X, feature_idx)
+        elif self.solver == 'incremental': self._fit_incremental(X, feature_idx)
+        else: raise ValueError(f'PCA solver \'{self.solver}\' not found.')
+        return self
+
+    def _fit_randomized(self, X, feature_idx):
+        "Streaming randomized SVD (Halko et al.) with mean-centering folded into products"
+        rng = np.random.default_rng(self.random_state)
+        n = X.shape[0]
+
+        # Feature means
+        mean = sum(np.asarray(c.sum(axis=0)).reshape(-1) for _, c in self._chunks(X, feature_idx)) / n
+        sketch_dim = min(self.n_components + self.n_oversamples, mean.shape[0], n)
+
+        # Products with the implicitly centered matrix
+        def right(B):  # (X - 1 mean^T) B
+            return np.concatenate([np.asarray(c @ B) - mean @ B for _, c in self._chunks(X, feature_idx)])
+        def left(A):  # (X - 1 mean^T)^T A
+            ret = -np.outer(mean, A.sum(axis=0))
+            for start, c in self._chunks(X, feature_idx): ret += np.asarray(c.T @ A[start:start+c.shape[0]])
+            return ret
+
+        # Find range with power iterations
+        Q = np.linalg.qr(right(rng.standard_normal((mean.shape[0], sketch_dim))))[0]
+        for _ in range(self.n_iter):
+            Q = np.linalg.qr(left(Q))[0]
+            Q = np.linalg.qr(right(Q))[0]
+
+        # Decompose projection
+        _, S, Vt = np.linalg.svd(left(Q).T, full_matrices=False)
+        self.mean_ = mean
+        self.components_ = Vt[:self.n_components]
+        self.singular_values_ = S[:self.n_components]
+        self.explained_variance_ = S[:self.n_components]**2 / (n - 1)
+
+    def _fit_incremental(self, X, feature_idx):
+        "Incremental PCA over dense row blocks"
+        ipca = sklearn.decomposition.IncrementalPCA(n_components=self.n_components)
+        for _, c in self._chunks(X, feature_idx, min_size=self.n_components):
+            ipca.partial_fit(c.toarray() if scipy.sparse.issparse(c) else c)
+        self.mean_ = ipca.mean_
+        self.components_ = ipca.components_
+        self.singular_values_ = ipca.singular_values_
+        self.explained_variance_ = ipca.explained_variance_
+
+    def transform(self, X):
+        # NOTE: Centering is applied after projection, so sparse input stays sparse
+        ret = np.empty((X.shape[0], self.components_.shape[0]))
+        for start, c in self._chunks(X): ret[start:start+c.shape[0]] = np.asarray(c @ self.components_.T)
+        ret -= self.mean_ @ self.components_.T
+        return ret
+
+    def inverse_transform(self, X):
+        ret = X @ self.components_ + self.mean_
+        if self.feature_scale is not None: ret *= self.feature_scale
+        return ret
+
+
+class TorchPCA:
+    "Low-rank PCA with `torch.pca_lowrank` on CPU tensors, transforming directly into float32 tensors"
+    def __init__(self, n_components, n_oversamples=10, n_iter=4):
+        self.n_components = n_components
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter  # Power iterations
+
+    def _to_tensor(self, X):
+        if torch.is_tensor(X): return X.to(torch.float32)
+        if scipy.sparse.issparse(X):
+            X = X.tocoo()
+            return torch.sparse_coo_tensor(torch.as_tensor(np.stack((X.row, X.col)), dtype=torch.long), X.data, X.shape, dtype=torch.float32)
+        return torch.as_tensor(np.asarray(X), dtype=torch.float32)
+
+    def fit(self, X, feature_idx=None):
+        if feature_idx is not None: X = X[:, feature_idx]
+        X = self._to_tensor(X)
+
+        # Decompose
+        # NOTE: Centering is implicit for sparse input
+        q = min(self.n_components + self.n_oversamples, *X.shape)
+        _, S, V = torch.pca_lowrank(X, q=q, center=True, niter=self.n_iter)
+        self.mean_ = (torch.sparse.sum(X, dim=0).to_dense() if X.is_sparse else X.sum(dim=0)) / X.shape[0]
+        self.components_ = V[:, :self.n_components].T.contiguous()
+        self.singular_values_ = S[:self.n_components]
+        self.explained_variance_ = S[:self.n_components]**2 / (X.shape[0] - 1)
+        return self
+
+    def transform(self, X):
+        ret = self._to_tensor(X) @ self.components_.T
+        ret -= self.mean_ @ self.components_.T
+        return ret
+
+    def inverse_transform(self, X):
+        # NOTE: Returns the input type, so standardization can be reversed with arrays
+        ret = self._to_tensor(X) @ self.components_ + self.mean_
+        return ret if torch.is_tensor(X) else ret.numpy()
+
+
 class Preprocessing:
     "Apply modifications to input modalities based on given arguments. Takes np.array as input"
+    cache_version = 1  # Increment when fitted parameters or cached outputs change layout or meaning
+
     def __init__(
         self,
         # Standardize
@@ -677,9 +1020,15 @@ class Preprocessing:
         # PCA
         pca_dim=512,
         pca_copy=True,  # Set to false if too much memory being used
+        pca_solver='auto',  # `auto`, chunked `randomized` or `incremental` for bounded memory, or `torch` for tensor output
+        sparse_center=False,  # Standardize and center sparse modalities implicitly within chunked PCA
+        chunk_size=int(1e4),  # Rows per block for chunked operations
+        n_jobs=1,  # Threads for fitting and transforming modalities concurrently, -1 for all cores
         # Subsampling
         num_nodes=None,
         num_features=None,
+        # Caching
+        cache_dir=None,  # Directory for fitted parameters and transformed modalities
         # End cast
         device=None,
         **kwargs,
@@ -688,12 +1037,21 @@ class Preprocessing:
         self.top_variant = top_variant
         self.pca_dim = pca_dim
         self.pca_copy = pca_copy  # Unused if sparse
+        self.pca_solver = pca_solver
+        self.sparse_center = sparse_center
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
         self.num_nodes = num_nodes
         self.num_features = num_features
+        self.cache_dir = cache_dir
         self.device = device
 
         # Data
         self.is_sparse_transform = None
+        self.is_pca_standardized = None
+
+        # Parameters which change fitted output
+        self.cache_params = ('standardize', 'top_variant', 'pca_dim', 'pca_solver', 'sparse_center')
 
     
     def fit(self, modalities, *args, total_statistics=False, **kwargs):
@@ -701,101 +1059,288 @@ class Preprocessing:
         self.is_sparse_transform = [scipy.sparse.issparse(m) for m in modalities]
         if isinstance(self.top_variant, int): self.top_variant = len(modalities) * [self.top_variant]
         if isinstance(self.pca_dim, int): self.pca_dim = len(modalities) * [self.pca_dim]
+        top_variant = self.top_variant if self.top_variant is not None else len(modalities) * [None]
+        pca_dim = self.pca_dim if self.pca_dim is not None else len(modalities) * [None]
+        # NOTE: Chunked solvers always fold standardization into PCA, as do sparse modalities with `sparse_center`
+        self.is_pca_standardized = [dim is not None and ((m_sparse and self.sparse_center) or self.pca_solver in ('randomized', 'incremental')) for m_sparse, dim in zip(self.is_sparse_transform, pca_dim)]
+
+        # Fit modalities independently
+        fitted = self._map(
+            lambda args: self._fit_modality(*args, total_statistics=total_statistics),
+            zip(modalities, self.is_sparse_transform, top_variant, pca_dim, self.is_pca_standardized))
+        standardize_mean, standardize_std, filter_mask, pca_class = [list(v) for v in zip(*fitted)]
+        if self.standardize or self.top_variant is not None: self.standardize_mean, self.standardize_std = standardize_mean, standardize_std
+        if self.top_variant is not None: self.filter_mask = filter_mask
+        if self.pca_dim is not None: self.pca_class = pca_class
+            
+        return self
+
+    def _map(self, func, iterable):
+        "Map `func` over modalities, concurrently if `n_jobs` is not 1"
+        # NOTE: Threads rather than processes, NumPy/BLAS release the GIL and modalities are not copied
+        if self.n_jobs == 1: return list(map(func, iterable))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_jobs if self.n_jobs > 0 else None) as executor:
+            return list(executor.map(func, iterable))
+
+    def _fit_modality(self, m, m_sparse, var, dim, m_fold, total_statistics=False):
+        "Fit standardization, filtering, and PCA for a single modality"
+        m_mean = m_std = mask = pca = None
 
         # Standardize
-        if self.standardize or self.top_variant is not None:
-            self.standardize_mean = [
-                np.mean(m, axis=0 if not total_statistics else None, keepdims=True)
-                if not m_sparse else
-                np.array(np.mean(m, axis=0 if not total_statistics else None).reshape((1, -1)))
-                for m, m_sparse in zip(modalities, self.is_sparse_transform)
-            ]
-            get_standardize_std = lambda total_statistics: [
+        # NOTE: Dense statistics are accumulated over row chunks for chunked solvers, bounding temporaries
+        if (self.standardize or self.top_variant is not None) and not m_sparse and self.pca_solver in ('randomized', 'incremental'):
+            feature_mean, feature_var = self._chunked_moments(m)
+            get_standardize_std = lambda total_statistics: np.sqrt(
+                feature_var
+                if not total_statistics else
+                np.mean(feature_var + np.square(feature_mean - feature_mean.mean()), keepdims=True))
+            m_mean = feature_mean if not total_statistics else feature_mean.mean(keepdims=True)
+            m_std = get_standardize_std(total_statistics)
+        elif self.standardize or self.top_variant is not None:
+            get_standardize_std = lambda total_statistics: (
                 np.std(m, axis=0 if not total_statistics else None, keepdims=True)
                 if not m_sparse else
-                np.array(np.sqrt(m.power(2).mean(axis=0 if not total_statistics else None) - np.square(m.mean(axis=0 if not total_statistics else None))).reshape((1, -1)))
-                for m, m_sparse in zip(modalities, self.is_sparse_transform)
-            ]
-            self.standardize_std = get_standardize_std(total_statistics)
+                np.array(np.sqrt(m.power(2).mean(axis=0 if not total_statistics else None) - np.square(m.mean(axis=0 if not total_statistics else None))).reshape((1, -1))))
+            m_mean = (
+                np.mean(m, axis=0 if not total_statistics else None, keepdims=True)
+                if not m_sparse else
+                np.array(np.mean(m, axis=0 if not total_statistics else None).reshape((1, -1))))
+            m_std = get_standardize_std(total_statistics)
 
         # Filtering
-        if self.top_variant is not None:
+        if var is not None:
             # Calculate per-feature variance if needed
-            st_std = self.standardize_std if not total_statistics else get_standardize_std(False)
+            st_std = m_std if not total_statistics else get_standardize_std(False)
 
             # Compute mask
-            self.filter_mask = [
-                np.argsort(std[0])[:-int(var+1):-1]
-                if var is not None else None
-                for std, var in zip(st_std, self.top_variant)
-            ]
-            modalities = [m[:, mask] if mask is not None else m for m, mask in zip(modalities, self.filter_mask)]
-            
+            mask = np.argsort(st_std[0])[:-int(var+1):-1]
+
             # Mask mean and std if needed
-            if not total_statistics:
-                self.standardize_mean = [st[:, mask] if mask is not None else st for m, st, mask in zip(modalities, self.standardize_mean, self.filter_mask)]
-                self.standardize_std = [st[:, mask] if mask is not None else st for m, st, mask in zip(modalities, self.standardize_std, self.filter_mask)]
+            if not total_statistics: m_mean, m_std = m_mean[:, mask], m_std[:, mask]
 
         # PCA
-        if self.pca_dim is not None:
-            self.pca_class = [
-                sklearn.decomposition.PCA(
-                    n_components=dim,
-                    svd_solver='auto' if not m_sparse else 'arpack',
-                    copy=self.pca_copy,
-                ).fit(m)
-                # sklearn.decomposition.TruncatedSVD(n_components=dim).fit(m)
-                if dim is not None else None
-                for m, m_sparse, dim in zip(modalities, self.is_sparse_transform, self.pca_dim)]
-            
-        return self
-
-    def transform(self, modalities, features=None, **kwargs):
+        # NOTE: Fit on filtered and standardized features, matching the input seen by `transform`
+        if dim is not None: pca = self._fit_pca(m, mask, m_sparse, *((m_mean, m_std) if self.standardize else (None, None)), m_fold, dim)
+
+        return m_mean, m_std, mask, pca
+
+    def _chunked_moments(self, m):
+        "Per-feature mean and variance of a dense modality, merged over the row chunks used by `ChunkedPCA`"
+        dtype = m.dtype if np.issubdtype(m.dtype, np.floating) else np.float64
+        n, mean, m2 = 0, 0., 0.
+        for _, chunk in ChunkedPCA(None, chunk_size=self.chunk_size)._chunks(m):
+            # Combine sums of squared deviations (Chan et al.)
+            chunk = np.asarray(chunk, dtype=np.float64)
+            chunk_n, chunk_mean = chunk.shape[0], chunk.mean(axis=0)
+            delta = chunk_mean - mean
+            m2 = m2 + np.square(chunk - chunk_mean).sum(axis=0) + np.square(delta) * n * chunk_n / (n + chunk_n)
+            mean = mean + delta * chunk_n / (n + chunk_n)
+            n += chunk_n
+        return mean.reshape((1, -1)).astype(dtype), (m2 / n).reshape((1, -1)).astype(dtype)
+
+    def _fit_pca(self, m, mask, m_sparse, m_mean, m_std, m_fold, dim):
+        "Fit PCA for a single modality on features `mask`, standardized if `m_std` is provided"
+        if dim is None: return None
+
+        # Chunked, with standardization folded into each block
+        if m_fold:
+            return ChunkedPCA(
+                dim,
+                solver=self.pca_solver if self.pca_solver in ('randomized', 'incremental') else 'randomized',
+                chunk_size=self.chunk_size,
+                feature_scale=np.where(m_std == 0, 1, m_std)[0] if m_std is not None else None,
+            ).fit(m, feature_idx=mask)
+
+        # Filter and standardize
+        if mask is not None: m = m[:, mask]
+        if m_std is not None: m = self._standardize(m, m_mean, m_std, m_sparse)
+
+        # Torch, transforming into tensors
+        if self.pca_solver == 'torch':
+            return TorchPCA(dim).fit(m)
+
+        # Whole matrix
+        return sklearn.decomposition.PCA(
+            n_components=dim,
+            svd_solver='auto' if not m_sparse else 'arpack',
+            copy=self.pca_copy,
+        ).fit(m)
+        # sklearn.decomposition.TruncatedSVD(n_components=dim).fit(m)
+
+    def transform(self, modalities, features=None, chunk_size=None, out=None, **kwargs):
         # Filtering
         # NOTE: Determines if filtering is already done by shape checking the main `modalities` input
-        if self.top_variant is not None and np.array([m.shape[1] != mask.shape[0] for m, mask in zip(modalities, self.filter_mask) if mask is not None]).any():
-            modalities = [m[:, mask] if mask is not None else m for m, mask in zip(modalities, self.filter_mask)]
-            if features is not None: features = [fs[mask] if mask is not None else fs for fs, mask in zip(features, self.filter_mask)]
+        do_filter = self._requires_filter(modalities)
+        if features is not None and do_filter: features = [fs[mask] if mask is not None else fs for fs, mask in zip(features, self.filter_mask)]
+
+        # Transform modalities independently, in row blocks if `chunk_size` or `out` are provided
+        modalities = self._map(
+            lambda args: self._apply_chunked(lambda m: self._transform_modality(args[0], m, do_filter=do_filter), *args[1:], chunk_size=chunk_size),
+            zip(range(len(modalities)), modalities, out if out is not None else len(modalities) * [None]))
+
+        ret = (modalities,)
+        if features is not None: ret += (features,)
+        return clean_return(ret)
+
+    def _requires_filter(self, modalities):
+        return self.top_variant is not None and np.array([m.shape[1] != mask.shape[0] for m, mask in zip(modalities, self.filter_mask) if mask is not None]).any()
+
+    def _transform_modality(self, i, m, do_filter=False):
+        "Filter, standardize, and project a single modality"
+        # Filtering
+        mask = self.filter_mask[i] if self.top_variant is not None else None
+        if do_filter and mask is not None: m = m[:, mask]
 
         # Standardize
-        # NOTE: Not mean-centered for sparse matrices
         # TODO: Maybe allow for only one dataset to be standardized?
-        if self.standardize:
-            modalities = [
-                (m - m_mean) / np.where(m_std == 0, 1, m_std) if not m_sparse else
-                (m / np.where(m_std == 0, 1, m_std)).tocsr() if scipy.sparse.issparse(m) else
-                (m / np.where(m_std == 0, 1, m_std))
-                for m, m_mean, m_std, m_sparse in zip(modalities, self.standardize_mean, self.standardize_std, self.is_sparse_transform)]
+        if self.standardize and not self.is_pca_standardized[i]:
+            m = self._standardize(m, self.standardize_mean[i], self.standardize_std[i], self.is_sparse_transform[i])
 
         # PCA
-        if self.pca_dim is not None:
-            modalities = [p.transform(m) if p is not None else m for m, p in zip(modalities, self.pca_class)]
+        if self.pca_dim is not None and self.pca_class[i] is not None: m = self.pca_class[i].transform(m)
 
-        ret = (modalities,)
-        if features is not None: ret += (features,)
-        return clean_return(ret)
+        return m
 
+    def _standardize(self, m, m_mean, m_std, m_sparse):
+        "Standardize a block of filtered features"
+        # NOTE: Not mean-centered for sparse matrices, unless folded into PCA
+        m_std = np.where(m_std == 0, 1, m_std)
+        if not m_sparse: return (m - m_mean) / m_std
+        elif scipy.sparse.issparse(m): return (m / m_std).tocsr()
+        else: return m / m_std
 
-    def inverse_transform(self, modalities, **kwargs):
+
+    def inverse_transform(self, modalities, chunk_size=None, out=None, **kwargs):
         # NOTE: Does not reverse top variant filtering or feature sampling, also always dense output
+        return self._map(
+            lambda args: self._apply_chunked(lambda m: self._inverse_transform_modality(args[0], m), *args[1:], chunk_size=chunk_size),
+            zip(range(len(modalities)), modalities, out if out is not None else len(modalities) * [None]))
+
+    def _inverse_transform_modality(self, i, m):
+        "Reverse projection and standardization of a single modality"
         # PCA
-        if self.pca_dim is not None:
-            modalities = [p.inverse_transform(m) for m, p in zip(modalities, self.pca_class)]
+        if self.pca_dim is not None and self.pca_class[i] is not None: m = self.pca_class[i].inverse_transform(m)
 
         # Standardize
-        if self.standardize:
+        # NOTE: Statistics are cast to tensors for `TorchPCA` output
+        if self.standardize and not self.is_pca_standardized[i]:
+            cast = (lambda v: torch.as_tensor(v, dtype=m.dtype, device=m.device)) if torch.is_tensor(m) else (lambda v: v)
+            m = cast(self.standardize_std[i]) * m + cast(self.standardize_mean[i]) if not self.is_sparse_transform[i] else cast(self.standardize_std[i]) * m
+
+        return m
+
+
+    def transform_chunks(self, modalities, chunk_size=None, inverse=False):
+        "Yield modality index, row offset, and (inverse) transformed row block, bounding temporaries to `chunk_size` rows"
+        do_filter = self._requires_filter(modalities) if not inverse else False
+        for i, m in enumerate(modalities):
+            func = (lambda m: self._transform_modality(i, m, do_filter=do_filter)) if not inverse else (lambda m: self._inverse_transform_modality(i, m))
+            for start, block in self._iter_chunked(func, m, chunk_size=chunk_size): yield i, start, block
+
+    def _iter_chunked(self, func, m, chunk_size=None):
+        chunk_size = chunk_size if chunk_size is not None else self.chunk_size
+        for start in range(0, m.shape[0], chunk_size): yield start, func(m[start:start+chunk_size])
+
+    def _apply_chunked(self, func, m, out=None, chunk_size=None):
+        "Apply `func` to all of `m`, or to row blocks written into `out` if `chunk_size` or `out` are provided"
+        if (chunk_size is None and out is None) or m.shape[0] == 0: return func(m)
+
+        # Apply to blocks
+        blocks = []
+        for start, block in self._iter_chunked(func, m, chunk_size=chunk_size):
+            if out is None and not scipy.sparse.issparse(block): out = (torch.empty if torch.is_tensor(block) else np.empty)((m.shape[0], block.shape[1]), dtype=block.dtype)
+            # NOTE: Sparse blocks are densified only when writing into a provided `out`
+            if out is not None: out[start:start+block.shape[0]] = block.toarray() if scipy.sparse.issparse(block) else block
+            else: blocks.append(block)
+        return out if out is not None else scipy.sparse.vstack(blocks, format='csr')
+
+    
+    def fit_transform(self, modalities, features=None, cache_key=None, **kwargs):
+        # Cached
+        if self.cache_dir is not None and cache_key is not None:
+            return self._fit_transform_cached(modalities, features, cache_key=cache_key, **kwargs)
+
+        self.fit(modalities, **kwargs)
+        return self.transform(modalities, features, **kwargs)
+
+
+    def _get_cache_path(self, modalities, cache_key, total_statistics=False, **kwargs):
+        "Content-addressed cache directory from dataset key, data fingerprints, and preprocessing parameters"
+        # NOTE: Only arguments that change fitted parameters are hashed, so default and explicit calls share entries
+        # NOTE: Per-modality parameters are normalized, as `fit` expands integers to lists in place
+        params = {k: getattr(self, k) for k in self.cache_params}
+        for k in ('top_variant', 'pca_dim'):
+            if params[k] is None: continue
+            if not isinstance(params[k], (list, tuple)): params[k] = len(modalities) * [params[k]]
+            params[k] = [int(v) if v is not None else None for v in params[k]]
+        params.update({
+            'cache_version': self.cache_version, 'cache_key': cache_key,
+            'modalities': [self._fingerprint(m) for m in modalities], 'total_statistics': bool(total_statistics)})
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f'{cache_key}_{digest}')
+
+    def _fingerprint(self, m, num_rows=64):
+        "Cheap description of a modality, hashing `num_rows` evenly spaced rows rather than all content"
+        m_sparse = scipy.sparse.issparse(m)
+        sample = m[np.unique(np.linspace(0, m.shape[0]-1, min(num_rows, m.shape[0])).astype(int))]
+        content = hashlib.sha1()
+        if m_sparse:
+            sample = sample.tocsr()
+            for v in (sample.data, sample.indices, sample.indptr): content.update(np.ascontiguousarray(v).tobytes())
+        else: content.update(np.ascontiguousarray(sample).tobytes())
+        return {
+            'sparse': m_sparse, 'dtype': str(m.dtype), 'shape': list(m.shape),
+            'nnz': int(m.nnz) if m_sparse else None, 'rows': content.hexdigest()}
+
+
+    def _fit_transform_cached(self, modalities, features=None, cache_key=None, **kwargs):
+        cache_path = self._get_cache_path(modalities, cache_key, **kwargs)
+        state_fname = os.path.join(cache_path, 'preprocessing.pt')
+        modality_fnames = [os.path.join(cache_path, f'modality_{i}') for i in range(len(modalities))]
+
+        # Load, memory-mapping dense modalities
+        # NOTE: Copy-on-write so downstream in-place operations never touch the cache
+        if os.path.exists(state_fname):
+            state = torch.load(state_fname, weights_only=False)
+            self.load_state_dict(state['preprocessing'])
             modalities = [
-                (m_std * m + m_mean)
-                if not m_sparse else
-                (m_std * m)
-                for m, m_mean, m_std, m_sparse in zip(modalities, self.standardize_mean, self.standardize_std, self.is_sparse_transform)]
+                np.load(f'{fname}.npy', mmap_mode='c') if os.path.exists(f'{fname}.npy') else
+                scipy.sparse.load_npz(f'{fname}.npz')
+                for fname in modality_fnames]
+            if features is not None: features = state['features']
 
-        return modalities
+        # Compute and save
+        # NOTE: State is written last and atomically, marking the cache as complete
+        else:
+            self.fit(modalities, **kwargs)
+            ret = self.transform(modalities, features, **kwargs)
+            modalities, features = (ret, None) if features is None else ret
+            os.makedirs(cache_path, exist_ok=True)
+            for m, fname in zip(modalities, modality_fnames):
+                if scipy.sparse.issparse(m): scipy.sparse.save_npz(f'{fname}.npz', m.tocsr())
+                else: np.save(f'{fname}.npy', np.asarray(m))
+            atomic_save({'preprocessing': self.state_dict(), 'features': features}, state_fname)
 
-    
-    def fit_transform(self, *args, **kwargs):
-        self.fit(*args, **kwargs)
-        return self.transform(*args, **kwargs)
+        ret = (modalities,)
+        if features is not None: ret += (features,)
+        return clean_return(ret)
+
+
+    def state_dict(self):
+        "Get fitted parameters"
+        # NOTE: Excludes runtime arguments, which may differ between runs sharing a cache
+        return {k: v for k, v in vars(self).items() if k not in ('chunk_size', 'n_jobs', 'num_nodes', 'num_features', 'cache_dir', 'device')}
+
+    def load_state_dict(self, state_dict):
+        "Load fitted parameters"
+        for k, v in state_dict.items(): setattr(self, k, v)
+        return self
+
+    def save(self, fname):
+        atomic_save(self.state_dict(), fname)
+
+    def load(self, fname):
+        return self.load_state_dict(torch.load(fname, weights_only=False))
     
 
     def cast(self, modalities, device=None, copy=False):
@@ -805,9 +1350,13 @@ class Preprocessing:
             device = self.device
 
         # Cast types
-        # NOTE: Always dense
+        # NOTE: Always dense, sparse matrices are only densified on `device` in float32, tensors are only moved
+        csr_to_tensor = lambda m: torch.sparse_csr_tensor(
+            torch.tensor(m.indptr), torch.tensor(m.indices), torch.tensor(m.data, dtype=torch.float32),
+            size=m.shape, device=device).to_dense()
         modalities = [
-            torch.tensor(m if not scipy.sparse.issparse(m) else m.todense(), dtype=torch.float32, device=device)
+            m.to(device=device, dtype=torch.float32) if torch.is_tensor(m) else
+            torch.tensor(m, dtype=torch.float32, device=device) if not scipy.sparse.issparse(m) else csr_to_tensor(m.tocsr())
             for m in modalities
         ]
 
@@ -823,7 +1372,7 @@ class Preprocessing:
         return modalities
     
     
-    def subsample(self, modalities, types=None, partition=None, return_idx=False, **kwargs):
+    def subsample(self, modalities, types=None, partition=None, partition_sampling='uniform', return_idx=False, **kwargs):
         # Subsample features
         # NOTE: Incompatible with inverse transform
         if self.num_features is not None:
@@ -832,15 +1381,19 @@ class Preprocessing:
 
         node_idx = np.arange(modalities[0].shape[0])
         # Partition
+        # NOTE: `partition` may be an array or a prebuilt `PartitionIndex`
         if partition is not None:
-            partition_choice = np.random.choice(np.unique(partition), 1)[0]
-            node_idx = node_idx[partition==partition_choice]
+            if not isinstance(partition, PartitionIndex): partition = PartitionIndex(partition)
+            if partition_sampling == 'uniform': node_idx = partition.choose(num_nodes=self.num_nodes)
+            elif partition_sampling == 'weighted': node_idx = partition.choose(weighted=True, num_nodes=self.num_nodes)
+            elif partition_sampling == 'stratified': node_idx = partition.stratify(self.num_nodes)
+            else: raise ValueError(f'Partition sampling \'{partition_sampling}\' not found.')
         
         # Subsample nodes
         if self.num_nodes is not None:
             assert np.array([m.shape[0] for m in modalities]).var() == 0, 'Nodes in all modalities must be equal to use node subsampling'
-            if len(node_idx) > self.num_nodes: node_idx = np.random.choice(node_idx, self.num_nodes, replace=False)
-            else: print(f'Skipping subsampling, only {len(node_idx)} nodes present.')
+            if len(node_idx) > self.num_nodes: node_idx = choice_without_replacement(node_idx, self.num_nodes)
+            elif len(node_idx) < self.num_nodes: print(f'Skipping subsampling, only {len(node_idx)} nodes present.')
             
         # Apply subsampling
         modalities = [m[node_idx] for m in modalities]
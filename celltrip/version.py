@@ -1 +1 @@
-__version__ = '1.0.0+2025-02-11'
+__version__ = '1.0.0+2026-10-18'
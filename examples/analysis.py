@@ -73,6 +73,8 @@ group.add_argument('run_id', type=str, help='Run ID from WandB to use for proces
 group.add_argument('analysis_key', choices=('convergence', 'discovery', 'temporal', 'perturbation'), nargs='+', type=str, help='Type of analyses to perform (one or more)')
 group.add_argument('-S', '--seed', type=int, help='Override simulation seed')
 group.add_argument('--gpu', default='0', type=str, help='GPU(s) to use')
+group.add_argument('--data_cache', action='store_true', help='Load the dataset from a memory-mapped binary cache, writing it on first load')
+group.add_argument('--cache_dir', type=str, help='Directory to cache fitted preprocessing and transformed modalities')
 
 # Model parameters
 group = parser.add_argument_group('Model')
@@ -175,7 +177,7 @@ print(f'\t\tWGT policy found at stage {latest_wgt[0]}')
 
 # Load data
 print(f'\tLoading dataset {config["data"]["dataset"]}')
-modalities, types, features = data.load_data(config['data']['dataset'], DATA_FOLDER)
+modalities, types, features = data.load_data(config['data']['dataset'], DATA_FOLDER, cache=args.data_cache, sparse=config['data'].get('sparse_center', False))
 # config['data'] = celltrip.utilities.overwrite_dict(config['data'], {'standardize': True})  # Old model compatibility
 # config['data'] = celltrip.utilities.overwrite_dict(config['data'], {'top_variant': config['data']['pca_dim'], 'pca_dim': None})  # Swap PCA with top variant (testing)
 if args.num_nodes is not None: config['data'] = celltrip.utilities.overwrite_dict(config['data'], {'num_nodes': args.num_nodes})
@@ -183,8 +185,9 @@ if args.max_batch is not None: config['train'] = celltrip.utilities.overwrite_di
 for k in ('standardize', 'pca_dim', 'top_variant'):
     # Legacy compatibility for missing default arguments
     if k not in config['data']: config['data'][k] = None
+config['data'] = celltrip.utilities.overwrite_dict(config['data'], {'cache_dir': args.cache_dir})
 ppc = celltrip.utilities.Preprocessing(**config['data'], device=DEVICE)
-modalities, features = ppc.fit_transform(modalities, features, total_statistics=args.total_statistics)
+modalities, features = ppc.fit_transform(modalities, features, cache_key=config['data']['dataset'], total_statistics=args.total_statistics)
 modalities, types = ppc.subsample(modalities, types)
 modalities = ppc.cast(modalities)
 # Assumes modalities are aligned
@@ -349,7 +352,7 @@ for ak in args.analysis_key:
         state_vars, end = state_manager(
             # present=present,
             state=env.get_state(),
-            modalities=ppc.cast(ppc.inverse_transform(ppc.inverse_cast(modalities)), device='cpu') if use_modalities else modalities,
+            modalities=ppc.cast(ppc.inverse_transform(ppc.inverse_cast(modalities), chunk_size=ppc.chunk_size), device='cpu') if use_modalities else modalities,
             labels=labels,
             times=times,
         )
@@ -359,7 +362,7 @@ for ak in args.analysis_key:
         env.set_state(full_state[memory_mask])
         raw_modalities = state_vars['modalities']
         processed_modalities = [m[memory_mask.cpu()] for m in raw_modalities]
-        if use_modalities: processed_modalities = ppc.cast(ppc.transform(ppc.inverse_cast(processed_modalities)))
+        if use_modalities: processed_modalities = ppc.cast(ppc.transform(ppc.inverse_cast(processed_modalities), chunk_size=ppc.chunk_size))
         env.set_modalities(processed_modalities)
 
         # Continue initializing
@@ -407,7 +410,7 @@ for ak in args.analysis_key:
             ):
                 raw_modalities = state_vars['modalities']
                 processed_modalities = [m[memory_mask.cpu()] for m in raw_modalities]
-                if use_modalities: processed_modalities = ppc.cast(ppc.transform(ppc.inverse_cast(processed_modalities)))
+                if use_modalities: processed_modalities = ppc.cast(ppc.transform(ppc.inverse_cast(processed_modalities), chunk_size=ppc.chunk_size))
                 env.set_modalities(processed_modalities)
 
             # Record
@@ -1,10 +1,76 @@
+import json
 import os
 
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 
-def load_data(dataset_name, data_folder):
+CACHE_VERSION = 2  # Increment when parsed layouts change, invalidating existing binary caches
+
+
+def load_data(dataset_name, data_folder, cache=False, sparse=False, **kwargs):
+    "Load dataset, from a binary cache in `data_folder` if `cache` and present, otherwise parsing and writing one"
+    # NOTE: `Random` is regenerated each call, caches are keyed by layout version and sparsity
+    cache_dir = os.path.join(data_folder, 'cache', f'{dataset_name}_v{CACHE_VERSION}' + ('_sparse' if sparse else ''))
+    cache = cache and dataset_name != 'Random'
+    if cache and os.path.exists(os.path.join(cache_dir, 'meta.json')): return load_cache(cache_dir)
+
+    modalities, types, features = parse_data(dataset_name, data_folder, sparse=sparse, **kwargs)
+    if cache: save_cache(cache_dir, modalities, types, features)
+    return modalities, types, features
+
+
+def save_cache(cache_dir, modalities, types, features):
+    "Write modalities as `.npy`, sparse as CSR components, with metadata written last to mark completion"
+    os.makedirs(cache_dir, exist_ok=True)
+    meta = {'version': CACHE_VERSION, 'sparse': [], 'shapes': []}
+    for i, m in enumerate(modalities):
+        if scipy.sparse.issparse(m):
+            m = m.tocsr()
+            for k in ('data', 'indices', 'indptr'): np.save(os.path.join(cache_dir, f'modality_{i}_{k}.npy'), getattr(m, k))
+        else: np.save(os.path.join(cache_dir, f'modality_{i}.npy'), np.asarray(m))
+        meta['sparse'].append(scipy.sparse.issparse(m))
+        meta['shapes'].append(list(m.shape))
+
+    # Labels may be object arrays
+    for name, arrays in (('types', types), ('features', features)):
+        for i, a in enumerate(arrays): np.save(os.path.join(cache_dir, f'{name}_{i}.npy'), np.asarray(a), allow_pickle=True)
+
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f: json.dump(meta, f)
+
+
+def load_cache(cache_dir):
+    "Memory-map cached modalities, copy-on-write so in-place operations never touch the cache"
+    with open(os.path.join(cache_dir, 'meta.json'), 'r') as f: meta = json.load(f)
+    load = lambda fname, **kwargs: np.load(os.path.join(cache_dir, f'{fname}.npy'), **kwargs)
+
+    modalities = [
+        scipy.sparse.csr_matrix(tuple(load(f'modality_{i}_{k}', mmap_mode='c') for k in ('data', 'indices', 'indptr')), shape=shape)
+        if sparse else load(f'modality_{i}', mmap_mode='c')
+        for i, (sparse, shape) in enumerate(zip(meta['sparse'], meta['shapes']))]
+    types = [load(f'types_{i}', allow_pickle=True) for i in range(len(modalities))]
+    features = [load(f'features_{i}', allow_pickle=True) for i in range(len(modalities))]
+
+    return modalities, types, features
+
+
+def read_sparse_tsv(fname, nrows=None, chunksize=1_000):
+    "Read a features x samples TSV as a samples x features CSR matrix, densifying only `chunksize` rows at a time"
+    blocks, features = [], []
+    for chunk in pd.read_csv(fname, delimiter='\t', nrows=nrows, chunksize=chunksize):
+        blocks.append(scipy.sparse.csr_matrix(chunk.to_numpy()))
+        features.append(chunk.index.to_numpy())
+    return scipy.sparse.vstack(blocks).T.tocsr(), chunk.columns.to_numpy(), np.concatenate(features)
+
+
+def read_backed_matrix(X, chunksize=10_000):
+    "Read a backed AnnData matrix as CSR, loading only `chunksize` rows from disk at a time"
+    return scipy.sparse.vstack([scipy.sparse.csr_matrix(X[start:start+chunksize]) for start in range(0, X.shape[0], chunksize)], format='csr')
+
+
+def parse_data(dataset_name, data_folder, sparse=False, backed=False):
+    # NOTE: `sparse` keeps sparse-native datasets as CSR, otherwise they are densified for `Preprocessing` defaults
     spatial_dataset_name_dict = {
         'MouseVisual': 'BARISTASeq',
         'BARISTASeq': 'BARISTASeq',
@@ -118,17 +184,19 @@ def load_data(dataset_name, data_folder):
     elif dataset_name == 'BrainChromatin':
         nrows = None  # 2_000
         dataset_dir = os.path.join(data_folder, 'brainchromatin')
-        M1 = pd.read_csv(os.path.join(dataset_dir, 'multiome_rna_counts.tsv'), delimiter='\t', nrows=nrows).transpose()  # 4.6 Gb in memory
-        M2 = pd.read_csv(os.path.join(dataset_dir, 'multiome_atac_gene_activities.tsv'), delimiter='\t', nrows=nrows).transpose()  # 2.6 Gb in memory
-        M2 = M2.transpose()[M1.index].transpose()
+        # NOTE: Parsed as CSR, 4.6 Gb and 2.6 Gb in memory if dense
+        M1, C1, F1 = read_sparse_tsv(os.path.join(dataset_dir, 'multiome_rna_counts.tsv'), nrows=nrows)
+        M2, C2, F2 = read_sparse_tsv(os.path.join(dataset_dir, 'multiome_atac_gene_activities.tsv'), nrows=nrows)
+        idx = pd.Index(C2).get_indexer(C1)
+        if (idx == -1).any(): raise ValueError(f'{(idx == -1).sum()} RNA cells not found in ATAC, e.g. \'{C1[idx == -1][0]}\'.')
+        M2 = M2[idx]
+        if not sparse: M1, M2 = M1.toarray(), M2.toarray()
         meta = pd.read_csv(os.path.join(dataset_dir, 'multiome_cell_metadata.txt'), delimiter='\t')
         meta_names = pd.read_csv(os.path.join(dataset_dir, 'multiome_cluster_names.txt'), delimiter='\t')
         meta_names = meta_names[meta_names['Assay'] == 'Multiome ATAC']
         meta = pd.merge(meta, meta_names, left_on='ATAC_cluster', right_on='Cluster.ID', how='left')
         meta.index = meta['Cell.ID']
-        T1 = T2 = meta.transpose()[M1.index].transpose()[['Cluster.Name']].to_numpy()
-        F1, F2 = M1.columns.to_numpy(), M2.columns.to_numpy()
-        M1, M2 = M1.to_numpy(), M2.to_numpy()
+        T1 = T2 = meta.loc[C1, ['Cluster.Name']].to_numpy()
 
         modalities = [M1, M2]
         types = [T1, T2]
@@ -140,10 +208,12 @@ def load_data(dataset_name, data_folder):
     elif dataset_name == 'scGLUE':
         import scanpy as sc
         dataset_dir = os.path.join(data_folder, 'scglue')
-        D1 = sc.read_h5ad(os.path.join(dataset_dir, 'Chen-2019-RNA.h5ad'))
-        D2 = sc.read_h5ad(os.path.join(dataset_dir, 'Chen-2019-ATAC.h5ad'))
-        M1 = np.asarray(D1.X.todense())
-        M2 = np.asarray(D2.X.todense())
+        # NOTE: Read as CSR, `backed` streams matrices from disk in row blocks rather than loading full AnnData objects
+        D1 = sc.read_h5ad(os.path.join(dataset_dir, 'Chen-2019-RNA.h5ad'), backed='r' if backed else None)
+        D2 = sc.read_h5ad(os.path.join(dataset_dir, 'Chen-2019-ATAC.h5ad'), backed='r' if backed else None)
+        M1 = read_backed_matrix(D1.X) if backed else scipy.sparse.csr_matrix(D1.X)
+        M2 = read_backed_matrix(D2.X) if backed else scipy.sparse.csr_matrix(D2.X)
+        if not sparse: M1, M2 = M1.toarray(), M2.toarray()
         T1 = D1.obs.cell_type.to_numpy().reshape((-1, 1))
         T2 = D2.obs.cell_type.to_numpy().reshape((-1, 1))
         F1 = D1.var.index.to_numpy()
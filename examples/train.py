@@ -1,6 +1,10 @@
 # %%
 from collections import defaultdict
+import json
 import os
+import socket
+import subprocess
+import sys
 
 import numpy as np
 import torch
@@ -60,6 +64,12 @@ group.add_argument('--dataset', type=str, required=True, help='Dataset to use')
 group.add_argument('--no_standardize', action='store_true', help='Don\'t standardize data')
 group.add_argument('--top_variant', type=int_or_none, nargs='*', help='Top variant features to filter for each modality')
 group.add_argument('--pca_dim', default=[512, 512], type=int_or_none, nargs='*', help='PCA features to generate for each modality')
+group.add_argument('--pca_solver', default='auto', choices=('auto', 'randomized', 'incremental', 'torch'), type=str, help='**PCA solver, `randomized` and `incremental` stream row chunks in bounded memory, `torch` outputs tensors directly')
+group.add_argument('--chunk_size', default=int(1e4), type=int, help='**Rows per chunk for chunked preprocessing')
+group.add_argument('--data_cache', action='store_true', help='**Load the dataset from a memory-mapped binary cache, writing it on first load')
+group.add_argument('--n_jobs', default=1, type=int, help='**Threads for preprocessing modalities concurrently, -1 for all cores')
+group.add_argument('--cache_dir', type=str, help='**Directory to cache fitted preprocessing and transformed modalities, keyed on dataset and preprocessing arguments')
+group.add_argument('--sparse_center', action='store_true', help='Load sparse-native datasets as CSR, standardizing and centering them implicitly within chunked PCA without densifying')
 group.add_argument('--num_nodes', type=int, nargs='*', help='Nodes to sample from data for each episode')
 
 # Environment parameters
@@ -84,6 +94,13 @@ group.add_argument('--update_batch', default=int(1e4), type=int, help='**Number
 group.add_argument('--update_minibatch', default=int(1e4), type=int, help='**Max memories to backprop at a time')
 group.add_argument('--update_load_level', default='minibatch', choices=('maxbatch', 'batch', 'minibatch'), help='**What stage to reconstruct memories from compressed form')
 group.add_argument('--update_cast_level', default='minibatch', choices=('maxbatch', 'batch', 'minibatch'), type=str, help='**What stage to cast to GPU memory')
+group.add_argument('--update_shuffle', action='store_true', help='Iterate over one permutation of the maxbatch each epoch, rather than a single random batch')
+group.add_argument('--update_prefetch', default=0, type=int, help='**Number of minibatches to load and cast ahead in a background thread during updates')
+group.add_argument('--memory_backend', default='columnar', choices=('list', 'columnar', 'memmap'), type=str, help='**Storage layout for memories, `columnar` preallocates contiguous tensors for `update_timesteps` and `memmap` additionally spills them to disk')
+group.add_argument('--memory_compression', choices=('float16', 'bfloat16', 'int8'), type=str, help='**Compress stored positional states, `int8` uses per-timestep affine quantization')
+group.add_argument('--memory_dir', type=str, help='**Directory for `memmap` memory files, defaults to the system temporary directory')
+group.add_argument('--update_pipeline', action='store_true', help='**Continue collecting rollouts with the pre-update policy while updating in the background')
+group.add_argument('--use_autocast', action='store_true', help='**Run policy networks in bfloat16 mixed precision')
 # Internal arguments
 group.add_argument('--feature_embed_dim', default=32, type=int, help='Dimension of modal embedding')
 group.add_argument('--embed_dim', default=64, type=int, help='Internal dimension of state representation')
@@ -91,7 +108,10 @@ group.add_argument('--embed_dim', default=64, type=int, help='Internal dimension
 group.add_argument('--action_std_init', default=.6, type=float, help='Initial policy randomness, in std')
 group.add_argument('--action_std_decay', default=.05, type=float, help='Policy randomness decrease per stage iteration')
 group.add_argument('--action_std_min', default=.15, type=float, help='Final policy randomness')
+group.add_argument('--epochs', default=80, type=int, help='Maximum number of epochs per policy update')
+group.add_argument('--target_kl', type=float, help='Approximate KL divergence from the old policy at which to end an update early')
 group.add_argument('--memory_prune', default=100, type=int, help='How many memories to prune from the end of the data')
+group.add_argument('--gae_lambda', type=float, help='Use generalized advantage estimation with this lambda, rather than Monte-Carlo returns')
 
 # Training parameters
 group = parser.add_argument_group('Training')
@@ -99,9 +119,14 @@ group.add_argument('--max_ep_timesteps', default=int(1e3), type=int, help='Numbe
 group.add_argument('--max_timesteps', default=int(5e6), type=int, help='Absolute max timesteps')
 group.add_argument('--update_timesteps', default=int(5e3), type=int, help='Number of timesteps per policy update')
 group.add_argument('--max_batch', default=None, type=int, help='**Max number of nodes to calculate actions for at a time')
+group.add_argument('--update_processes', default=1, type=int, help='**Number of local CPU processes to split each policy update across (gloo)')
 group.add_argument('--no_episode_random_samples', action='store_true', help='Don\'t refresh episode each epoch')
 group.add_argument('--episode_partitioning_feature', type=int, help='Type feature to partition by for episode random samples')
+group.add_argument('--episode_partitioning_sampling', default='uniform', choices=('uniform', 'weighted', 'stratified'), type=str, help='Sample one partition uniformly or weighted by size, or sample nodes across partitions proportionally')
 group.add_argument('--use_wandb', action='store_true', help='**Record performance to wandb')
+group.add_argument('--checkpoint_timesteps', type=int, help='**Timesteps between full training checkpoints, written at episode ends')
+group.add_argument('--checkpoint_memory', action='store_true', help='**Include memory buffers in training checkpoints')
+group.add_argument('--resume', action='store_true', help='**Resume training from the latest checkpoint, if present and written with the same non-runtime arguments')
 
 # Early stopping parameters
 group = parser.add_argument_group('Early Stopping')
@@ -135,6 +160,7 @@ for k in ('buffer', 'window_size'):
 # Default dimension parameters
 arg_groups['Policy']['positional_dim'] = 2*arg_groups['Environment']['dim']
 arg_groups['Policy']['output_dim'] = arg_groups['Environment']['dim']
+arg_groups['Policy']['memory_capacity'] = arg_groups['Training']['update_timesteps']
 
 # Unencode env stages
 env_stages_encoded = arg_groups['Environment'].pop('env_stages')
@@ -160,7 +186,7 @@ if torch.cuda.is_available(): torch.cuda.manual_seed(arg_groups['General']['seed
 np.random.seed(arg_groups['General']['seed'])
 
 # Load data
-modalities, types, features = data.load_data(arg_groups['Data']['dataset'], DATA_FOLDER)
+modalities, types, features = data.load_data(arg_groups['Data']['dataset'], DATA_FOLDER, cache=arg_groups['Data']['data_cache'], sparse=arg_groups['Data']['sparse_center'])
 
 # Filter data (TemporalBrain)
 # mask = [(t.startswith('Adol') or t.startswith('Inf')) for t in types[0][:, 1]]
@@ -168,7 +194,7 @@ modalities, types, features = data.load_data(arg_groups['Data']['dataset'], DATA
 
 # Preprocess data
 ppc = celltrip.utilities.Preprocessing(**arg_groups['Data'], device=DEVICE)
-processed_modalities, features = ppc.fit_transform(modalities, features)
+processed_modalities, features = ppc.fit_transform(modalities, features, cache_key=arg_groups['Data']['dataset'])
 modalities = processed_modalities
 
 # Fixed samples
@@ -177,11 +203,13 @@ if not arg_groups['Training']['episode_random_samples']:
     processed_modalities = ppc.cast(processed_modalities)
     modalities = processed_modalities
 
-# CLI
+# Partitions
 else:
+    # NOTE: Partitioning currently only supports aligned modalities
+    partition_index = None
     if arg_groups['Training']['episode_partitioning_feature'] is not None:
-        names, counts = np.unique(types[0][:, arg_groups['Training']['episode_partitioning_feature']], return_counts=True)
-        print('Episode groups: ' + ', '.join([f'{n} ({c})' for n, c in zip(names, counts)]))
+        partition_index = celltrip.utilities.PartitionIndex(types[0][:, arg_groups['Training']['episode_partitioning_feature']])
+        print('Episode groups: ' + ', '.join([f'{n} ({c})' for n, c in zip(partition_index.groups, partition_index.counts)]))  # CLI
 
 # %% [markdown]
 # # Train Policy
@@ -203,6 +231,26 @@ arg_groups['Policy']['modal_dims'] = [m.shape[1] for m in env.get_return_modalit
 policy = celltrip.models.PPO(**arg_groups['Policy'], device=DEVICE).train()
 early_stopping = celltrip.utilities.EarlyStopping(**arg_groups['Early Stopping'])
 
+# Start distributed update workers
+# NOTE: Rank 0 collects rollouts, all ranks share each update
+update_processes = arg_groups['Training']['update_processes']
+if update_processes > 1:
+    # NOTE: All ranks update on CPU, and collectives can't be issued from a background learner
+    assert torch.device(DEVICE).type == 'cpu', '`--update_processes` requires running on CPU, launch with `CUDA_VISIBLE_DEVICES=\'\'`'
+    assert not policy.update_pipeline, '`--update_processes` is incompatible with `--update_pipeline`'
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        init_method = f'tcp://127.0.0.1:{sock.getsockname()[1]}'
+    # NOTE: Workers run a separate entry script, as this script can't be safely re-imported by `spawn`
+    update_workers = [
+        subprocess.Popen([
+            sys.executable, os.path.join(BASE_FOLDER, 'update_worker.py'),
+            '--rank', str(rank), '--world_size', str(update_processes), '--init_method', init_method,
+            '--policy_kwargs', json.dumps({**arg_groups['Policy'], 'device': 'cpu'}),
+            '--num_threads', str(max(1, os.cpu_count() // update_processes))])
+        for rank in range(1, update_processes)]
+    torch.distributed.init_process_group('gloo', init_method=init_method, rank=0, world_size=update_processes)
+
 # Initialize wandb
 if arg_groups['Training']['use_wandb']: wandb.init(
     project='CellTRIP',
@@ -222,6 +270,27 @@ torch.cuda.reset_peak_memory_stats()
 timer = celltrip.utilities.time_logger(discard_first_sample=True)
 timestep = 0; episode = 1; stage = 0
 
+# Resume from checkpoint
+# NOTE: Only checkpoints written with the same arguments, ignoring runtime (`**`) arguments, are resumed
+checkpoint_file = os.path.join(MODEL_FOLDER, 'checkpoint.pt')
+checkpoint_writer = celltrip.utilities.CheckpointWriter()
+runtime_args = {a.dest for a in parser._actions if a.help is not None and a.help.startswith('**')}
+checkpoint_config = {k1: {k2: v2 for k2, v2 in v1.items() if k2 not in runtime_args} if isinstance(v1, dict) else v1 for k1, v1 in arg_groups.items()}
+if arg_groups['Training']['resume'] and os.path.exists(checkpoint_file):
+    checkpoint = torch.load(checkpoint_file, weights_only=False)
+    if checkpoint.get('config') != checkpoint_config:
+        raise ValueError(f'Checkpoint \'{checkpoint_file}\' was written with different arguments, remove it or run without `--resume`.')
+    policy.load_training_state_dict(checkpoint['policy'])
+    early_stopping.load_state_dict(checkpoint['early_stopping'])
+    timestep, episode, stage = checkpoint['timestep'], checkpoint['episode'], checkpoint['stage']
+    env.set_rewards(arg_groups['Stages'][min(stage, len(arg_groups['Stages'])-1)])
+    torch.set_rng_state(checkpoint['rng']['torch'])
+    if torch.cuda.is_available() and checkpoint['rng']['cuda'] is not None: torch.cuda.set_rng_state_all(checkpoint['rng']['cuda'])
+    np.random.set_state(checkpoint['rng']['numpy'])
+    print(f'Resuming from checkpoint on episode {episode} and timestep {timestep}')
+    del checkpoint
+last_checkpoint_timestep = timestep
+
 # CLI
 print('Beginning training')
 
@@ -231,8 +300,8 @@ while timestep < arg_groups['Training']['max_timesteps']:
     if arg_groups['Training']['episode_random_samples']:
         modalities, keys = ppc.subsample(
             processed_modalities,
-            # NOTE: Partitioning currently only supports aligned modalities
-            partition=types[0][:, arg_groups['Training']['episode_partitioning_feature']] if arg_groups['Training']['episode_partitioning_feature'] is not None else None,
+            partition=partition_index,
+            partition_sampling=arg_groups['Training']['episode_partitioning_sampling'],
             return_idx=True)
         modalities = ppc.cast(modalities)
         env.set_modalities(modalities)
@@ -264,14 +333,14 @@ while timestep < arg_groups['Training']['max_timesteps']:
 
             # Record rewards for policy
             policy.memory.record(
-                rewards=rewards.cpu().tolist(),
+                rewards=rewards,  # Kept on device
                 is_terminals=finished,
             )
 
-            # Record rewards for logging
-            ep_reward = ep_reward + rewards.cpu().mean()
+            # Record rewards for logging, on device until the end of the episode
+            ep_reward = ep_reward + rewards.mean()
             for k, v in itemized_rewards.items():
-                ep_itemized_reward[k] += v.cpu().mean()
+                ep_itemized_reward[k] += v.mean()
             timer.log('Record Rewards')
 
         # Iterate
@@ -281,10 +350,15 @@ while timestep < arg_groups['Training']['max_timesteps']:
         # Update model
         if timestep % arg_groups['Training']['update_timesteps'] == 0:
             # assert False
-            print(f'Updating model with average reward {np.mean(sum(policy.memory.storage["rewards"], []))} on episode {episode} and timestep {timestep}', end='')
-            policy.update()
-            print(f' ({torch.cuda.max_memory_allocated() / 1024**3:.2f} GB CUDA)')
-            torch.cuda.reset_peak_memory_stats()
+            print(f'Updating model with average reward {policy.memory.mean_reward()} on episode {episode} and timestep {timestep}', end='')
+            checkpoint_writer.wait_snapshot()  # Weights and memories are modified by the update
+            if policy.update_pipeline:
+                policy.update_async()  # Rollouts continue during update
+                print()
+            else:
+                policy.update()
+                print(f' ({torch.cuda.max_memory_allocated() / 1024**3:.2f} GB CUDA)')
+                torch.cuda.reset_peak_memory_stats()
             timer.log('Update Policy')
 
         # Escape if finished
@@ -307,11 +381,15 @@ while timestep < arg_groups['Training']['max_timesteps']:
             'average_reward': ep_reward,
             },
             **{'rewards/'+k: (v / ep_timestep).item() for k, v in ep_itemized_reward.items()},
+            **{'update/'+k: v for k, v in policy.update_statistics.items()},
         })
     timer.log('Record Stats')
 
     # Decay model std
     if early_stopping(ep_reward) or timestep >= arg_groups['Training']['max_timesteps']:
+        # Finish background update
+        policy.wait_update()
+
         # Save model
         wgt_file = os.path.join(MODEL_FOLDER, f'policy_{stage:02}.wgt')
         torch.save(policy.state_dict(), wgt_file)  # Save just weights
@@ -337,6 +415,7 @@ while timestep < arg_groups['Training']['max_timesteps']:
             env.set_rewards(arg_groups['Stages'][stage])
         else:
             # Decay policy randomness
+            checkpoint_writer.wait_snapshot()  # Modifies weights in place
             policy.decay_action_std()
             # CLI
             print(f'Decaying std to {policy.action_std} on episode {episode} and timestep {timestep}')
@@ -349,6 +428,40 @@ while timestep < arg_groups['Training']['max_timesteps']:
     # Iterate
     episode += 1
 
+    # Checkpoint full training state
+    # NOTE: Deferred to a later episode while a background update is running, rather than waiting
+    if (
+        arg_groups['Training']['checkpoint_timesteps'] is not None
+        and timestep - last_checkpoint_timestep >= arg_groups['Training']['checkpoint_timesteps']
+        and not policy.is_updating()
+    ):
+        policy.wait_update()  # Raise learner errors
+        checkpoint_writer.save({
+            'policy': policy.training_state_dict(include_memory=arg_groups['Training']['checkpoint_memory']),
+            'early_stopping': early_stopping.state_dict(),
+            'timestep': timestep,
+            'episode': episode,
+            'stage': stage,
+            'config': checkpoint_config,
+            'rng': {
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                'numpy': np.random.get_state(),
+            },
+        }, checkpoint_file)
+        last_checkpoint_timestep = timestep
+        timer.log('Checkpoint')
+
+# Finish background update and checkpoint writes
+policy.wait_update()
+checkpoint_writer.wait()
+
+# Stop distributed update workers
+if update_processes > 1:
+    policy.stop_updates()
+    for worker in update_workers: worker.wait()
+    torch.distributed.destroy_process_group()
+
 # CLI Timer
 print()
 timer.aggregate('sum')
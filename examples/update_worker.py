@@ -0,0 +1,18 @@
+# Entrypoint for non-zero ranks of a distributed policy update, launched by `train.py`
+# NOTE: Ranks are started as separate interpreters so that they never re-run the training script
+import argparse
+import json
+
+import celltrip
+
+# Arguments
+parser = argparse.ArgumentParser(description='Serve distributed CellTRIP policy updates', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--rank', type=int, required=True, help='Rank of this process, must be nonzero')
+parser.add_argument('--world_size', type=int, required=True, help='Total number of update processes, including rank 0')
+parser.add_argument('--init_method', type=str, required=True, help='URL used to initialize the gloo process group')
+parser.add_argument('--policy_kwargs', type=json.loads, required=True, help='JSON of keyword arguments used to construct the policy on rank 0')
+parser.add_argument('--num_threads', type=int, help='Number of CPU threads to use for this rank')
+args = parser.parse_args()
+
+# Serve updates until rank 0 stops
+celltrip.models.distributed_update_worker(args.rank, args.world_size, args.init_method, args.policy_kwargs, num_threads=args.num_threads)
@@ -24,6 +24,7 @@ setup(
             'memory-profiler',
             'memray',
             'pip-tools',
+            'pytest',
             'snakeviz',
         ],
         'examples': [
@@ -0,0 +1,55 @@
+import importlib.util
+import json
+import os
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+pytest.importorskip('pandas')
+
+
+# Example loaders aren't part of the package
+spec = importlib.util.spec_from_file_location('data', os.path.join(os.path.dirname(__file__), '..', 'examples', 'data.py'))
+data = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(data)
+
+
+def test_cache_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    modalities = [rng.normal(size=(30, 4)), scipy.sparse.random(30, 10, density=.3, format='csr', random_state=0)]
+    types = [np.array([['a', 0], ['b', 1]] * 15, dtype=object), np.arange(30).reshape(-1, 1)]
+    features = [np.array(['f0', 'f1', 'f2', 'f3']), np.arange(10)]
+    data.save_cache(tmp_path, modalities, types, features)
+    with open(os.path.join(tmp_path, 'meta.json'), 'r') as f: assert json.load(f)['version'] == data.CACHE_VERSION
+    cached_modalities, cached_types, cached_features = data.load_cache(tmp_path)
+
+    # Dense modalities are memory-mapped, sparse kept as CSR
+    assert isinstance(cached_modalities[0], np.memmap)
+    assert scipy.sparse.isspmatrix_csr(cached_modalities[1])
+    np.testing.assert_array_equal(cached_modalities[0], modalities[0])
+    np.testing.assert_array_equal(cached_modalities[1].toarray(), modalities[1].toarray())
+    for c, e in zip(cached_types + cached_features, types + features): np.testing.assert_array_equal(c, e)
+
+    # Copy-on-write, the cache is never modified
+    cached_modalities[0][:] = 0
+    cached_modalities[1].data[:] = 0
+    reloaded, _, _ = data.load_cache(tmp_path)
+    np.testing.assert_array_equal(reloaded[0], modalities[0])
+    np.testing.assert_array_equal(reloaded[1].toarray(), modalities[1].toarray())
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_load_data_cache(tmp_path, monkeypatch, sparse):
+    parsed = ([np.ones((3, 2))], [np.zeros((3, 1))], [np.arange(2)])
+    calls = []
+    def parse_data(dataset_name, data_folder, **kwargs):
+        calls.append(kwargs)
+        return parsed
+    monkeypatch.setattr(data, 'parse_data', parse_data)
+
+    # Parsed once, then loaded from a cache keyed by layout version and sparsity
+    for _ in range(2): modalities, _, _ = data.load_data('Test', tmp_path, cache=True, sparse=sparse)
+    assert calls == [{'sparse': sparse}]
+    assert os.listdir(os.path.join(tmp_path, 'cache')) == [f'Test_v{data.CACHE_VERSION}' + ('_sparse' if sparse else '')]
+    np.testing.assert_array_equal(modalities[0], parsed[0][0])
@@ -0,0 +1,232 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from celltrip import models
+
+
+BACKENDS = {
+    'list': models.AdvancedMemoryBuffer,
+    'columnar': models.ColumnarMemoryBuffer,
+    'memmap': models.MemmapMemoryBuffer,
+}
+
+
+def fill_memory(memory, num_timesteps=12, num_keys=6, num_present=4, feature_dim=5, suffix_len=2, seed=0):
+    "Record random memories with a changing subset of keys present at each timestep, returning full states"
+    rng = np.random.default_rng(seed)
+    suffixes = torch.tensor(rng.normal(size=(num_keys, suffix_len)), dtype=torch.float32)
+    random = lambda *shape: torch.tensor(rng.normal(size=shape), dtype=torch.float32)
+    states_list = []
+    for t in range(num_timesteps):
+        keys = rng.choice(num_keys, num_present, replace=False)
+        states = torch.concat((random(num_present, feature_dim), suffixes[keys]), dim=1)
+        memory.record(
+            keys=[f'cell_{k}' for k in keys],
+            states=states,
+            actions=random(num_present, 3),
+            action_logs=random(num_present),
+            state_vals=random(num_present),
+        )
+        memory.record(rewards=random(num_present), is_terminals=t % 5 == 4)
+        states_list.append(states)
+    return states_list
+
+
+def assert_memories_equal(actual, expected):
+    for k in ('actions', 'action_logs', 'state_vals'): torch.testing.assert_close(actual[k], expected[k])
+    for a, e in zip(actual['states'], expected['states']): torch.testing.assert_close(a, e)
+
+
+@pytest.mark.parametrize('backend, kwargs', [
+    ('columnar', {}),
+    ('columnar', {'capacity': 3}),  # Grown
+    ('columnar', {'capacity': 100}),
+    ('memmap', {}),
+    ('memmap', {'capacity': 3}),
+])
+def test_backend_matches_list(backend, kwargs):
+    reference, memory = models.AdvancedMemoryBuffer(2), BACKENDS[backend](2, **kwargs)
+    fill_memory(reference)
+    fill_memory(memory)
+
+    assert len(memory) == len(reference)
+    idx = np.arange(len(reference))
+    assert_memories_equal(memory[idx], reference[idx])
+    torch.testing.assert_close(memory.propagate_rewards(), reference.propagate_rewards())
+    assert memory.mean_reward() == pytest.approx(reference.mean_reward())
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_clear_and_refill(backend):
+    reference, memory = models.AdvancedMemoryBuffer(2), BACKENDS[backend](2)
+    fill_memory(memory, seed=1)
+    memory.clear(clear_persistent=True)
+    assert len(memory) == 0
+
+    # Refilled memories don't depend on cleared ones
+    fill_memory(reference, num_timesteps=5, seed=2)
+    fill_memory(memory, num_timesteps=5, seed=2)
+    idx = np.arange(len(reference))
+    assert_memories_equal(memory[idx], reference[idx])
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_batched_retrieval_matches_single(backend):
+    memory = BACKENDS[backend](2)
+    fill_memory(memory)
+
+    # Unordered indices spanning several timesteps
+    idx = np.random.default_rng(1).permutation(len(memory))[:20]
+    batch = memory[idx]
+    for j, i in enumerate(idx):
+        single = memory[int(i)]
+        for k in ('actions', 'action_logs', 'state_vals'): torch.testing.assert_close(batch[k][j], single[k][0])
+        for b, s in zip(batch['states'], single['states']): torch.testing.assert_close(b[j], s[0])
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_retrieval_out_of_range(backend):
+    memory = BACKENDS[backend](2)
+    fill_memory(memory)
+    with pytest.raises(IndexError): memory[[0, len(memory)]]
+    with pytest.raises(IndexError): memory[-1]
+
+
+def reference_returns(memory, gamma):
+    "Per-memory reverse scan with a running return per key, as in the original implementation"
+    offsets = memory._get_offsets()
+    key_ids, rewards, is_terminals = memory._get_reward_columns()
+    returns, counts = np.empty(len(rewards)), np.empty(len(rewards), dtype=np.int64)
+    running_returns, running_counts = {}, {}
+    for t in reversed(range(len(offsets) - 1)):
+        for j in reversed(range(offsets[t], offsets[t+1])):
+            k = key_ids[j]
+            if is_terminals[t]: running_returns[k], running_counts[k] = 0, 0
+            running_returns[k] = rewards[j] + gamma * running_returns.get(k, 0)
+            running_counts[k] = running_counts.get(k, 0) + 1
+            returns[j], counts[j] = running_returns[k], running_counts[k]
+    return returns, counts
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('prune', [0, 2])
+def test_propagate_rewards_matches_reference(backend, prune):
+    memory = BACKENDS[backend](2)
+    fill_memory(memory)
+    expected, counts = reference_returns(memory, .95)
+    mask = counts > prune
+
+    # Normalized by statistics of unpruned returns
+    statistics = models.utilities.RunningStatistics(n_set=memory.running_statistics.n_set)
+    for r in expected[mask]: statistics.update(r)
+    expected = (expected - float(statistics.mean())) / np.sqrt(float(statistics.variance()) + 1e-8)
+
+    returns, returns_mask = memory.propagate_rewards(gamma=.95, prune=prune)
+    np.testing.assert_array_equal(returns_mask.numpy(), mask)
+    np.testing.assert_allclose(returns.numpy(), expected, rtol=1e-5, atol=1e-5)
+
+
+def reference_advantages(memory, gamma, gae_lambda, mean, std):
+    "Per-key GAE over unnormalized values, bootstrapping until terminal states, normalized by `std`"
+    offsets = memory._get_offsets()
+    key_ids, rewards, is_terminals = memory._get_reward_columns()
+    values = memory._get_column('state_vals').reshape(-1).double().numpy()
+    advantages, running, next_values = np.empty(len(rewards)), {}, {}
+    for t in reversed(range(len(offsets) - 1)):
+        for j in range(offsets[t], offsets[t+1]):
+            k = key_ids[j]
+            if is_terminals[t]:
+                running.pop(k, None)
+                next_values.pop(k, None)
+            bootstrap = gamma * (std * next_values[k] + mean) if k in next_values else 0
+            delta = rewards[j] + bootstrap - (std * values[j] + mean)
+            running[k] = delta + gamma * gae_lambda * running.get(k, 0)
+            advantages[j] = running[k] / std
+            next_values[k] = values[j]
+    return advantages
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('gae_lambda', [0, .9, 1])
+def test_gae_matches_reference(backend, gae_lambda):
+    memory = BACKENDS[backend](2)
+    fill_memory(memory)
+    returns, advantages, mask = memory.estimate_advantages(gamma=.95, gae_lambda=gae_lambda, prune=0)
+
+    # Compare with statistics updated by the call
+    mean = float(memory.running_statistics.mean())
+    std = np.sqrt(float(memory.running_statistics.variance()) + 1e-8)
+    expected = reference_advantages(memory, .95, gae_lambda, mean, std)
+    values = memory._get_column('state_vals').reshape(-1).numpy()
+    assert mask.all()
+    np.testing.assert_allclose(advantages.numpy(), expected, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(returns.numpy(), expected + values, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_monte_carlo_advantages(backend):
+    memory, reference = BACKENDS[backend](2), BACKENDS[backend](2)
+    fill_memory(memory)
+    fill_memory(reference)
+    returns, advantages, mask = memory.estimate_advantages(gamma=.95, prune=0)
+    expected, expected_mask = reference.propagate_rewards(gamma=.95, prune=0)
+    torch.testing.assert_close(returns, expected)
+    torch.testing.assert_close(mask, expected_mask)
+    torch.testing.assert_close(advantages, expected - memory._get_column('state_vals').reshape(-1))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_states_reconstructed_with_suffixes(backend):
+    memory = BACKENDS[backend](2)
+    states = fill_memory(memory, num_timesteps=20, num_keys=9)
+    for t, s in enumerate(states): torch.testing.assert_close(memory._get_timestep_state(t), s)
+
+    # One table row per key, grown as keys appear
+    num_keys = len(memory.persistent_storage['key_ids'])
+    assert num_keys <= 9
+    assert memory.persistent_storage['suffixes'].shape[0] >= num_keys
+
+
+def test_key_ids_shared_across_key_types():
+    memory = models.AdvancedMemoryBuffer(2)
+    states = torch.arange(12, dtype=torch.float32).reshape(3, 4)
+    ids = memory._get_key_ids(torch.tensor([5, 1, 3]), states)
+    assert ids.tolist() == [0, 1, 2]
+
+    # Tensor and integer keys map to the same ids, suffixes are kept from first appearance
+    assert memory._get_key_ids([3, 5, 7], states.flip(0)).tolist() == [2, 0, 3]
+    torch.testing.assert_close(memory.persistent_storage['suffixes'][:4], torch.stack((states[0, 2:], states[1, 2:], states[2, 2:], states[0, 2:])))
+
+
+def test_memmap_removes_replaced_files(tmp_path):
+    memory = models.MemmapMemoryBuffer(2, capacity=1, directory=tmp_path)
+    fill_memory(memory, num_timesteps=20)
+
+    # One file per live column, those of grown columns are removed
+    columns = [v for v in memory.storage.values() if v is not None]
+    assert len(os.listdir(memory.directory.name)) == len(columns) == len(memory.files)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('compression', ['float16', 'bfloat16', 'int8'])
+def test_state_compression_error(backend, compression):
+    memory = BACKENDS[backend](2, state_compression=compression)
+    states = fill_memory(memory)
+    for t, s in enumerate(states):
+        reconstructed = memory._get_timestep_state(t)
+
+        # Suffixes are stored uncompressed
+        torch.testing.assert_close(reconstructed[:, -2:], s[:, -2:])
+
+        # Rounding error of each format
+        s, error = s[:, :-2], (reconstructed[:, :-2] - s[:, :-2]).abs()
+        if compression == 'int8': bound = (s.max(dim=0).values - s.min(dim=0).values) / 255 / 2 + 1e-5
+        else: bound = s.abs() * {'float16': 2**-11, 'bfloat16': 2**-8}[compression] + 1e-6
+        assert (error <= bound).all()
+
+
+def test_state_compression_not_found():
+    with pytest.raises(ValueError): models.AdvancedMemoryBuffer(2, state_compression='int4')
@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+
+from celltrip import models, utilities
+
+
+POLICY_KWARGS = {
+    'positional_dim': 4,
+    'modal_dims': [3, 2],
+    'output_dim': 2,
+    'feature_embed_dim': 8,
+    'embed_dim': 8,
+    'num_heads': 2,
+    'epochs': 1,
+    'memory_prune': 0,
+    'update_batch': None,
+    'update_minibatch': 8,
+}
+
+
+def make_policy(seed=0, **kwargs):
+    torch.manual_seed(seed)
+    return models.PPO(**{**POLICY_KWARGS, **kwargs}).train()
+
+
+def fill_policy_memory(policy, num_timesteps=10, num_keys=6, seed=0):
+    "Record random rollouts through `act_macro`"
+    rng = np.random.default_rng(seed)
+    random = lambda *shape: torch.tensor(rng.normal(size=shape), dtype=torch.float32)
+    modalities = random(num_keys, sum(POLICY_KWARGS['modal_dims']))
+    for t in range(num_timesteps):
+        state = torch.concat((random(num_keys, POLICY_KWARGS['positional_dim']), modalities), dim=1)
+        with torch.no_grad(): policy.act_macro(state, keys=[f'cell_{k}' for k in range(num_keys)])
+        policy.memory.record(rewards=random(num_keys), is_terminals=t == num_timesteps-1)
+
+
+def record_gradients(policy):
+    "Record gradients of all optimized parameters at each optimizer step"
+    gradients, step = [], policy.optimizer.step
+    def recorded_step(*args, **kwargs):
+        gradients.append([
+            p.grad.clone() if p.grad is not None else torch.zeros_like(p)
+            for group in policy.optimizer.param_groups for p in group['params']])
+        return step(*args, **kwargs)
+    policy.optimizer.step = recorded_step
+    return gradients
+
+
+def distributed_gradients(rank, world_size, init_method, fname_prefix):
+    "Run one distributed update, saving the gradients seen by this rank"
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+    policy = make_policy(seed=rank)  # Weights are broadcast from rank 0
+    gradients = record_gradients(policy)
+    if rank == 0:
+        fill_policy_memory(policy)
+        policy.update(seed=0)
+        policy.stop_updates()
+    else: policy.serve_updates()
+    torch.save(gradients, f'{fname_prefix}{rank}.pt')
+    dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason='Distributed not available')
+def test_distributed_gradients_match_single_process(tmp_path):
+    # Single process
+    policy = make_policy()
+    expected = record_gradients(policy)
+    fill_policy_memory(policy)
+    policy.update(seed=0)
+
+    # Two ranks
+    # NOTE: The full maxbatch is used as the batch, so gradients don't depend on the sampled order
+    world_size = 2
+    torch.multiprocessing.spawn(
+        distributed_gradients,
+        args=(world_size, f'file://{tmp_path / "init"}', str(tmp_path / 'gradients_')),
+        nprocs=world_size)
+
+    # Summed gradients on every rank should match
+    assert len(expected) == 1
+    for rank in range(world_size):
+        actual = torch.load(tmp_path / f'gradients_{rank}.pt')
+        assert len(actual) == len(expected)
+        for a, e in zip(actual[0], expected[0]): torch.testing.assert_close(a, e, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('target_kl, kwargs, expected_steps', [
+    (None, {}, 3),
+    (-1, {}, 1),  # Always exceeded, so only the first step is taken
+    (-1, {'max_nodes': 3}, 1),  # Redrawn neighbors, nonzero KL before the first step
+])
+def test_update_target_kl(target_kl, kwargs, expected_steps):
+    policy = make_policy(epochs=3, target_kl=target_kl, **kwargs)
+    gradients = record_gradients(policy)
+    fill_policy_memory(policy)
+    policy.update(seed=0)
+
+    assert len(gradients) == policy.update_statistics['steps'] == expected_steps
+    assert policy.update_statistics['epochs'] == expected_steps
+
+
+def test_update_shuffle_covers_maxbatch(monkeypatch):
+    # Record staged batches
+    staged, stage = [], utilities.Sampler.stage
+    def recorded_stage(self, stage_name, idx):
+        if stage_name == 'batch': staged.append(np.asarray(idx))
+        return stage(self, stage_name, idx)
+    monkeypatch.setattr(utilities.Sampler, 'stage', recorded_stage)
+
+    epochs, maxbatch_size, batch_size = 3, 50, 7
+    policy = make_policy(epochs=epochs, update_shuffle=True, update_maxbatch=maxbatch_size, update_batch=batch_size)
+    gradients = record_gradients(policy)
+    fill_policy_memory(policy)
+    policy.update(seed=0)
+
+    # Each epoch steps over one permutation of the maxbatch
+    batches_per_epoch = -(-maxbatch_size // batch_size)
+    assert len(staged) == len(gradients) == epochs * batches_per_epoch
+    for epoch in range(epochs):
+        epoch_idx = np.concatenate(staged[epoch*batches_per_epoch:(epoch+1)*batches_per_epoch])
+        np.testing.assert_array_equal(np.sort(epoch_idx), np.arange(maxbatch_size))
+
+
+@pytest.mark.parametrize('include_memory', [False, True])
+def test_training_state_round_trip(include_memory):
+    # Train once, then record new memories
+    policy = make_policy()
+    fill_policy_memory(policy)
+    policy.update(seed=0)
+    policy.decay_action_std()
+    fill_policy_memory(policy, seed=1)
+
+    loaded = make_policy(seed=1)
+    loaded.load_training_state_dict(policy.training_state_dict(include_memory=include_memory))
+    assert loaded.action_std == policy.action_std
+    assert len(loaded.memory) == (len(policy.memory) if include_memory else 0)
+    for k, v in policy.state_dict().items(): torch.testing.assert_close(loaded.state_dict()[k], v)
+
+    # Optimizer, scheduler, reward statistics, and memories continue training identically
+    if include_memory:
+        for p in (policy, loaded): p.update(seed=1)
+        for k, v in policy.state_dict().items(): torch.testing.assert_close(loaded.state_dict()[k], v)
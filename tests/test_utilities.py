@@ -0,0 +1,371 @@
+import itertools
+import os
+
+import numpy as np
+import pytest
+import scipy.sparse
+import sklearn.decomposition
+import torch
+
+from celltrip import utilities
+
+
+def assert_statistics_close(actual, expected):
+    assert actual.n == expected.n
+    assert float(actual.mean()) == pytest.approx(float(expected.mean()), rel=1e-9, abs=1e-12)
+    assert float(actual.variance()) == pytest.approx(float(expected.variance()), rel=1e-9, abs=1e-12)
+
+
+@pytest.mark.parametrize('n_set', [None, 1, 10, 1e5])
+def test_update_batch_matches_sequential(n_set):
+    x = torch.tensor(np.random.default_rng(0).normal(3, 2, size=1000))
+    sequential, batch = utilities.RunningStatistics(n_set=n_set), utilities.RunningStatistics(n_set=n_set)
+    for v in x: sequential.update(v)
+    batch.update_batch(x[:300])
+    batch.update_batch(x[300:300])  # Empty
+    batch.update_batch(x[300:])
+    assert_statistics_close(batch, sequential)
+
+
+def test_merge_matches_sequential():
+    x = np.random.default_rng(0).normal(-1, 3, size=500)
+    a, b, full = utilities.RunningStatistics(), utilities.RunningStatistics(), utilities.RunningStatistics()
+    for v in x[:120]: a.update(v)
+    for v in x[120:]: b.update(v)
+    for v in x: full.update(v)
+    a.merge(b)
+    assert_statistics_close(a, full)
+
+
+def test_merge_empty():
+    x = np.random.default_rng(0).normal(size=50)
+    a, empty, expected = utilities.RunningStatistics(), utilities.RunningStatistics(), utilities.RunningStatistics()
+    for v in x:
+        a.update(v)
+        expected.update(v)
+    a.merge(empty)
+    assert_statistics_close(a, expected)
+    empty.merge(a)
+    assert_statistics_close(empty, expected)
+
+
+@pytest.mark.parametrize('depth', [0, 1, 3])
+def test_prefetcher_order(depth):
+    assert list(utilities.Prefetcher(range(50), depth=depth)) == list(range(50))
+
+
+def test_prefetcher_raises():
+    def items():
+        yield 0
+        raise RuntimeError('Failed')
+    prefetcher = utilities.Prefetcher(items(), depth=2)
+    assert next(prefetcher) == 0
+    with pytest.raises(RuntimeError): next(prefetcher)
+    assert not prefetcher.thread.is_alive()
+
+
+def test_prefetcher_close():
+    produced = []
+    def items():
+        for i in itertools.count():
+            produced.append(i)
+            yield i
+    prefetcher = utilities.Prefetcher(items(), depth=2)
+    assert next(prefetcher) == 0
+
+    # Stops an unfinished iterator, having prepared at most `depth` items and one waiting
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+    assert len(produced) <= 4
+
+
+def test_checkpoint_writer(tmp_path):
+    fname = tmp_path / 'checkpoint.pt'
+    x = torch.arange(5.)
+    writer = utilities.CheckpointWriter()
+    writer.save({'x': x, 'step': 1}, fname)
+    writer.wait_snapshot()
+    x += 1  # Modifications after the snapshot aren't written
+    writer.wait()
+    checkpoint = torch.load(fname)
+    torch.testing.assert_close(checkpoint['x'], torch.arange(5.))
+    assert checkpoint['step'] == 1
+
+    # Replaced without leaving temporary files
+    writer.save({'x': x, 'step': 2}, fname)
+    writer.wait()
+    assert torch.load(fname)['step'] == 2
+    assert os.listdir(tmp_path) == ['checkpoint.pt']
+
+
+def test_checkpoint_writer_raises(tmp_path):
+    writer = utilities.CheckpointWriter()
+    writer.save({'step': 1}, tmp_path / 'missing' / 'checkpoint.pt')
+    with pytest.raises((RuntimeError, OSError)): writer.wait()
+    writer.wait()  # Raised once
+
+
+@pytest.mark.parametrize('load_stage, cast_stage', [
+    ('maxbatch', 'maxbatch'),
+    ('maxbatch', 'minibatch'),
+    ('batch', 'minibatch'),
+    ('minibatch', 'minibatch'),
+])
+def test_sampler_stages(load_stage, cast_stage):
+    source = utilities.TensorDictSource({
+        'actions': torch.arange(100, dtype=torch.float32).reshape(50, 2),
+        'states': [torch.arange(50), torch.arange(150, dtype=torch.float32).reshape(50, 3)],
+    })
+    targets = 10 * torch.arange(50, dtype=torch.float32)
+    sampler = utilities.Sampler(source, targets, load_stage, cast_stage, 'cpu')
+    rng = np.random.default_rng(0)
+
+    # Minibatches hold the memories of their absolute indices
+    sampler.stage('maxbatch', sampler.sample('maxbatch', 40, rng=rng))
+    sampler.stage('batch', sampler.sample('batch', 20, rng=rng))
+    minibatches = []
+    for _ in range(2):
+        data = sampler.stage('minibatch', sampler.sample('minibatch', 5, rng=rng))
+        expected = {**source[sampler.idxs[2]], 'targets': targets[sampler.idxs[2]]}
+        torch.testing.assert_close(data, expected)
+        minibatches.append((data, expected))
+
+    # Rotated buffers keep the previous minibatch intact
+    torch.testing.assert_close(*minibatches[0])
+
+
+@pytest.mark.parametrize('device', [
+    'cpu',
+    pytest.param('cuda', marks=pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA not available')),
+])
+def test_sampler_buffers_reused(device):
+    source = utilities.TensorDictSource({'actions': torch.arange(100, dtype=torch.float32).reshape(50, 2)})
+    targets = 10 * torch.arange(50, dtype=torch.float32)
+    sampler = utilities.Sampler(source, targets, 'batch', 'minibatch', device, non_blocking=True)
+    sampler.stage('maxbatch', np.arange(50))
+    sampler.stage('batch', np.arange(50)[::-1])
+
+    # Smaller minibatches are written into the existing buffers, pinned when casting to CUDA
+    for size in (10, 10, 5, 7, 3, 10):
+        data = sampler.stage('minibatch', np.arange(size))
+        torch.testing.assert_close(data['actions'].cpu(), source['actions'][sampler.idxs[2]])
+    buffers = [b['actions'] for b in sampler.buffers[2]]
+    assert [b.shape[0] for b in buffers] == [10, 10]
+    assert all(b.is_pinned() == (device == 'cuda') for b in buffers)
+
+
+def low_rank_data(num_samples=300, num_features=40, rank=5, seed=0):
+    "Low-rank samples with small noise, and differently scaled and offset features"
+    rng = np.random.default_rng(seed)
+    X = (rng.normal(size=(num_samples, rank)) * np.linspace(10, 2, rank)) @ rng.normal(size=(rank, num_features))
+    X += .01 * rng.normal(size=X.shape)
+    return X * rng.uniform(.1, 10, size=num_features) + rng.uniform(-5, 5, size=num_features)
+
+
+def assert_same_embedding(actual, expected, rtol=1e-4):
+    "Compare projections up to the sign of each component"
+    actual, expected = np.asarray(actual, dtype=np.float64), np.asarray(expected, dtype=np.float64)
+    signs = np.sign((actual * expected).sum(axis=0))
+    np.testing.assert_allclose(actual * signs, expected, rtol=rtol, atol=rtol * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('solver', ['randomized', 'incremental'])
+@pytest.mark.parametrize('sparse', [False, True])
+def test_chunked_pca_matches_sklearn(solver, sparse):
+    X = low_rank_data()
+    X_input = scipy.sparse.csr_matrix(X) if sparse else X
+    expected = sklearn.decomposition.PCA(n_components=5).fit(X)
+    pca = utilities.ChunkedPCA(5, solver=solver, chunk_size=64, random_state=0).fit(X_input)
+
+    np.testing.assert_allclose(pca.explained_variance_, expected.explained_variance_, rtol=1e-3)
+    assert_same_embedding(pca.transform(X_input), expected.transform(X), rtol=1e-3)
+    np.testing.assert_allclose(pca.inverse_transform(pca.transform(X_input)), X, atol=1e-2 * np.abs(X).max())
+
+
+@pytest.mark.parametrize('solver', ['randomized', 'incremental', 'torch'])
+def test_preprocessing_solvers_match(solver):
+    X = low_rank_data(rank=3)
+    expected_ppc = utilities.Preprocessing(top_variant=None, pca_dim=3, pca_solver='auto')
+    expected = expected_ppc.fit_transform([X])[0]
+    ppc = utilities.Preprocessing(top_variant=None, pca_dim=3, pca_solver=solver, chunk_size=64)
+    actual = ppc.fit_transform([X])[0]
+
+    # All solvers fit on the standardized input they transform
+    assert_same_embedding(actual, expected, rtol=1e-3)
+    reconstructed, expected_reconstructed = ppc.inverse_transform([actual])[0], expected_ppc.inverse_transform([expected])[0]
+    np.testing.assert_allclose(np.asarray(reconstructed), expected_reconstructed, atol=1e-3 * np.abs(X).max())
+
+
+@pytest.mark.parametrize('total_statistics', [False, True])
+def test_chunked_statistics_match_whole_matrix(total_statistics):
+    X = low_rank_data()
+    expected = utilities.Preprocessing(top_variant=20, pca_dim=None).fit([X], total_statistics=total_statistics)
+    ppc = utilities.Preprocessing(top_variant=20, pca_dim=None, pca_solver='randomized', chunk_size=64).fit([X], total_statistics=total_statistics)
+
+    np.testing.assert_allclose(ppc.standardize_mean[0], expected.standardize_mean[0])
+    np.testing.assert_allclose(ppc.standardize_std[0], expected.standardize_std[0])
+    np.testing.assert_array_equal(ppc.filter_mask[0], expected.filter_mask[0])
+
+
+def test_sparse_center_matches_dense():
+    X = low_rank_data(rank=3)
+    expected_ppc = utilities.Preprocessing(top_variant=None, pca_dim=3)
+    expected = expected_ppc.fit_transform([X])[0]
+    ppc = utilities.Preprocessing(top_variant=None, pca_dim=3, sparse_center=True, chunk_size=64)
+    actual = ppc.fit_transform([scipy.sparse.csr_matrix(X)])[0]
+
+    # Standardized and centered implicitly
+    assert ppc.is_pca_standardized == [True]
+    assert_same_embedding(actual, expected, rtol=1e-3)
+    np.testing.assert_allclose(ppc.inverse_transform([actual])[0], expected_ppc.inverse_transform([expected])[0], atol=1e-3 * np.abs(X).max())
+
+
+def test_sparse_standardize_without_pca():
+    X = scipy.sparse.random(50, 20, density=.2, format='csr', random_state=0)
+    ppc = utilities.Preprocessing(top_variant=None, pca_dim=None)
+    actual = ppc.fit_transform([X])[0]
+
+    # Scaled but not centered, staying sparse
+    assert scipy.sparse.issparse(actual)
+    std = X.toarray().std(axis=0)
+    np.testing.assert_allclose(actual.toarray(), X.toarray() / np.where(std == 0, 1, std), rtol=1e-6, atol=1e-12)
+
+
+def test_chunked_transform_matches_whole_matrix():
+    modalities = [low_rank_data(rank=3), scipy.sparse.random(300, 20, density=.2, format='csr', random_state=0)]
+    ppc = utilities.Preprocessing(top_variant=None, pca_dim=[3, None]).fit(modalities)
+    expected = ppc.transform(modalities)
+    dense = lambda m: m.toarray() if scipy.sparse.issparse(m) else np.asarray(m)
+
+    # Row blocks, sparse blocks stay sparse
+    chunked = ppc.transform(modalities, chunk_size=64)
+    assert scipy.sparse.issparse(chunked[1])
+    for c, e in zip(chunked, expected): np.testing.assert_allclose(dense(c), dense(e))
+
+    # Written into provided arrays, densifying sparse blocks
+    out = [np.empty(e.shape) for e in expected]
+    for r, o, e in zip(ppc.transform(modalities, chunk_size=64, out=out), out, expected):
+        assert r is o
+        np.testing.assert_allclose(o, dense(e))
+
+    # Generated blocks
+    blocks = [[], []]
+    for i, start, block in ppc.transform_chunks(modalities, chunk_size=64): blocks[i].append((start, block))
+    for b, e in zip(blocks, expected):
+        assert [start for start, _ in b] == list(range(0, 300, 64))
+        np.testing.assert_allclose(np.concatenate([dense(block) for _, block in b]), dense(e))
+
+    # Inverse, in row blocks, into provided arrays, and generated
+    expected_inverse = ppc.inverse_transform(expected[:1])[0]
+    np.testing.assert_allclose(ppc.inverse_transform(expected[:1], chunk_size=64)[0], expected_inverse)
+    out = np.empty(expected_inverse.shape)
+    ppc.inverse_transform(expected[:1], out=[out])
+    np.testing.assert_allclose(out, expected_inverse)
+    inverse_blocks = [block for _, _, block in ppc.transform_chunks(expected[:1], chunk_size=64, inverse=True)]
+    np.testing.assert_allclose(np.concatenate(inverse_blocks), expected_inverse)
+
+
+@pytest.mark.parametrize('n_jobs', [2, -1])
+def test_concurrent_modalities_match_sequential(n_jobs):
+    modalities = [low_rank_data(rank=3), scipy.sparse.csr_matrix(low_rank_data(num_features=30, rank=3, seed=1)), low_rank_data(seed=2)]
+    kwargs = {'top_variant': 20, 'pca_dim': [3, None, 4], 'pca_solver': 'incremental', 'chunk_size': 64}
+    expected_ppc = utilities.Preprocessing(**kwargs, n_jobs=1).fit(modalities)
+    ppc = utilities.Preprocessing(**kwargs, n_jobs=n_jobs).fit(modalities)
+
+    # Fitted parameters and outputs are in modality order
+    dense = lambda m: m.toarray() if scipy.sparse.issparse(m) else np.asarray(m)
+    for a, e in zip(ppc.filter_mask, expected_ppc.filter_mask): np.testing.assert_array_equal(a, e)
+    for a, e in zip(ppc.standardize_std, expected_ppc.standardize_std): np.testing.assert_array_equal(a, e)
+    for a, e in zip(ppc.transform(modalities), expected_ppc.transform(modalities)): np.testing.assert_allclose(dense(a), dense(e))
+
+
+def test_cast_sparse():
+    X = scipy.sparse.random(50, 20, density=.2, format='csr', random_state=0)
+    ppc = utilities.Preprocessing(device='cpu')
+    torch.testing.assert_close(ppc.cast([X])[0], torch.tensor(X.toarray(), dtype=torch.float32))
+
+
+def test_cache_hit_matches_fresh_fit(tmp_path):
+    modalities = [low_rank_data(rank=3), scipy.sparse.csr_matrix(low_rank_data(num_features=30, rank=3, seed=1))]
+    features = [np.arange(m.shape[1]) for m in modalities]
+    kwargs = {'top_variant': 20, 'pca_dim': [3, None], 'cache_dir': tmp_path}
+
+    # Written on the first call, loaded on the second
+    fresh_ppc = utilities.Preprocessing(**kwargs)
+    fresh, fresh_features = fresh_ppc.fit_transform(modalities, features, cache_key='test')
+    ppc = utilities.Preprocessing(**kwargs)
+    cached, cached_features = ppc.fit_transform(modalities, features, cache_key='test')
+    assert len(os.listdir(tmp_path)) == 1
+
+    # Outputs and fitted parameters are restored
+    dense = lambda m: m.toarray() if scipy.sparse.issparse(m) else np.asarray(m)
+    for c, f in zip(cached, fresh): np.testing.assert_array_equal(dense(c), dense(f))
+    for c, f in zip(cached_features, fresh_features): np.testing.assert_array_equal(c, f)
+    for c, f in zip(ppc.transform(modalities), fresh): np.testing.assert_allclose(dense(c), dense(f))
+
+
+def test_cache_path_fingerprint(tmp_path):
+    X = low_rank_data()
+    ppc = utilities.Preprocessing(top_variant=20, pca_dim=3, cache_dir=tmp_path)
+    path = ppc._get_cache_path([X], 'test')
+
+    # Content, sparsity, and dtype change the path
+    X_changed = X.copy()
+    X_changed[-1, 0] += 1
+    assert ppc._get_cache_path([X_changed], 'test') != path
+    assert ppc._get_cache_path([scipy.sparse.csr_matrix(X)], 'test') != path
+    assert ppc._get_cache_path([X.astype(np.float32)], 'test') != path
+
+    # Equivalent parameters, and those expanded by fitting, don't
+    assert utilities.Preprocessing(top_variant=[20], pca_dim=[3], cache_dir=tmp_path)._get_cache_path([X], 'test') == path
+    ppc.fit([X])
+    assert ppc._get_cache_path([X], 'test') == path
+
+    # Fit arguments are hashed with their defaults
+    assert ppc._get_cache_path([X], 'test', total_statistics=False) == path
+    assert ppc._get_cache_path([X], 'test', total_statistics=True) != path
+
+
+def test_partition_index_groups():
+    partition = np.random.default_rng(0).choice(['a', 'b', 'c', 'd'], size=200, p=[.5, .3, .15, .05])
+    index = utilities.PartitionIndex(partition)
+    assert len(index) == 4
+    assert index.counts.sum() == 200
+    for group, idx, count in zip(index.groups, index.index, index.counts):
+        assert len(idx) == count
+        assert (partition[idx] == group).all()
+    assert sorted(np.concatenate(index.index)) == list(range(200))
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_partition_index_choose(weighted):
+    partition = np.repeat([0, 1, 2], [5, 40, 100])
+    index = utilities.PartitionIndex(partition)
+    for _ in range(20):
+        idx = index.choose(weighted=weighted, num_nodes=10)
+        assert len(np.unique(partition[idx])) == 1
+        assert len(idx) == min(10, (partition == partition[idx[0]]).sum())
+        assert len(np.unique(idx)) == len(idx)
+
+
+@pytest.mark.parametrize('num_nodes', [1, 7, 50, 145])
+def test_partition_index_stratify(num_nodes):
+    partition = np.repeat([0, 1, 2], [5, 40, 100])
+    index = utilities.PartitionIndex(partition)
+    idx = index.stratify(num_nodes)
+    assert len(idx) == num_nodes
+    assert len(np.unique(idx)) == num_nodes
+
+    # Within rounding of proportional allocation
+    quota = num_nodes * index.counts / index.counts.sum()
+    counts = np.array([(partition[idx] == g).sum() for g in index.groups])
+    assert ((counts >= np.floor(quota)) & (counts <= np.ceil(quota))).all()
+
+
+def test_subsample_partition():
+    modalities = [np.arange(145 * 2).reshape(145, 2), np.arange(145 * 3).reshape(145, 3)]
+    partition = np.repeat([0, 1, 2], [5, 40, 100])
+    ppc = utilities.Preprocessing(num_nodes=10)
+    sampled, idx = ppc.subsample(modalities, partition=utilities.PartitionIndex(partition), return_idx=True)
+    assert len(np.unique(partition[idx])) == 1
+    for m, s in zip(modalities, sampled): np.testing.assert_array_equal(s, m[idx])